@@ -1,21 +1,35 @@
-import os, sys, json, re, time, uuid, random, traceback, threading
-from datetime import datetime
+import os, sys, re, time, uuid, random, traceback, threading, hashlib, queue, functools, atexit, unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor, Future
+from datetime import datetime, timedelta, timezone
+from io import BytesIO
+from base64 import b64decode, b64encode
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
-from linebot.exceptions import InvalidSignatureError
+from linebot.exceptions import LineBotApiError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import MessageEvent, TextMessage, TextSendMessage, ImageSendMessage
 import requests
+import orjson
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import logging
+import logging.handlers
 
 # =============== 日誌設定 ===============
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(levelname)s %(asctime)s %(message)s",
-    datefmt="%Y-%m-%dT%H:%M:%S%z",
-    force=True,
-)
-log = logging.getLogger("app")
+# 各執行緒只把 log record 丟進 queue 就返回，真正寫 stdout 由單一 listener 執行緒負責，
+# webhook / 生圖 / Firestore 執行緒不會卡在搶 stdout 的鎖與 write syscall 上
 sys.stdout.reconfigure(encoding="utf-8")
+_log_queue = queue.SimpleQueue()
+_log_stream = logging.StreamHandler(sys.stdout)
+_log_stream.setFormatter(logging.Formatter("%(levelname)s %(asctime)s %(message)s", datefmt="%Y-%m-%dT%H:%M:%S%z"))
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream)
+_log_listener.start()
+atexit.register(_log_listener.stop)   # 結束前把 queue 裡剩下的 log 寫完
+_log_handler = logging.handlers.QueueHandler(_log_queue)
+_log_handler.setFormatter(logging.Formatter("%(message)s"))   # 等級與時間由 listener 端的 formatter 加上
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler], force=True)
+log = logging.getLogger("app")
 
 # =============== 基礎設定 ===============
 app = Flask(__name__)
@@ -24,21 +38,131 @@ LINE_CHANNEL_SECRET = os.environ.get("LINE_CHANNEL_SECRET")
 OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY")
 GCS_BUCKET = os.environ.get("GCS_BUCKET", "storybotimage")
 IMAGE_SIZE_ENV = (os.environ.get("IMAGE_SIZE") or "1024x1024").strip()
+# LINE 只吃 JPEG / PNG；JPEG 體積約為 PNG 的 1/5，OpenAI 回傳、GCS 上傳、LINE 下載都更快
+IMAGE_FORMAT = (os.environ.get("IMAGE_FORMAT") or "jpeg").strip().lower()
+if IMAGE_FORMAT not in ("jpeg", "png"):
+    IMAGE_FORMAT = "jpeg"
+IMAGE_COMPRESSION = int(os.environ.get("IMAGE_COMPRESSION", "85"))
+IMAGE_EXT = "jpg" if IMAGE_FORMAT == "jpeg" else "png"
+IMAGE_CONTENT_TYPE = f"image/{IMAGE_FORMAT}"
+# 生圖模型與品質：童書插圖用 medium 就夠，比預設（auto，多半是 high）快很多也便宜；可改成 gpt-image-1-mini 再加速
+IMAGE_MODEL = (os.environ.get("IMAGE_MODEL") or "gpt-image-1").strip()
+IMAGE_QUALITY = (os.environ.get("IMAGE_QUALITY") or "medium").strip().lower()
 
 if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
     log.error("LINE credentials missing.")
 if not OPENAI_API_KEY:
     log.warning("OPENAI_API_KEY is empty; image generation will fail.")
 
-line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN)
+# =============== HTTP 連線池（重用 TCP/TLS 連線，含重試） ===============
+HTTP = requests.Session()
+HTTP.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=50,
+    max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504]),
+))
+
+# LINE SDK 預設每次呼叫都用 requests.post 開新連線；改走上面的共用 session，reply / push 重用連線
+class PooledLineHttpClient(RequestsHttpClient):
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = HTTP.get(url, headers=headers, params=params, stream=stream,
+                            timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = HTTP.post(url, headers=headers, data=data,
+                             timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = HTTP.put(url, headers=headers, data=data,
+                            timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = HTTP.delete(url, headers=headers, data=data,
+                               timeout=self.timeout if timeout is None else timeout)
+        return RequestsHttpResponse(response)
+
+line_bot_api = LineBotApi(LINE_CHANNEL_ACCESS_TOKEN, http_client=PooledLineHttpClient)
 handler = WebhookHandler(LINE_CHANNEL_SECRET)
+
+# webhook 事件改在背景執行緒處理，/callback 驗完簽章就先回 200
+# 每位使用者固定分到同一條單執行緒 lane：同一人的訊息依序處理（故事句子不會跑到後面那句「整理」之後），
+# 不同使用者仍然並行
+WEBHOOK_WORKERS = int(os.environ.get("WEBHOOK_WORKERS", "8"))
+webhook_lanes = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"webhook-{i}") for i in range(WEBHOOK_WORKERS)]
+# 排隊中的事件設上限：塞太久 reply token 也過期了，不如回 503 讓 LINE 之後重送。
+# lane 上只做 session 讀寫與快速回覆（LLM / 生圖都交給背景池），每則約數十到數百 ms，
+# 64 則排隊的等待時間仍遠低於 reply token 的有效期限
+WEBHOOK_MAX_PENDING = int(os.environ.get("WEBHOOK_MAX_PENDING", "64"))
+_webhook_pending = threading.BoundedSemaphore(WEBHOOK_MAX_PENDING)
+
+# 畫圖（OpenAI 生圖 + GCS 上傳 + push）統一交給固定大小的執行緒池，不再每次開新 thread
+IMAGE_WORKERS = int(os.environ.get("IMAGE_WORKERS", "8"))
+image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image")
+
+# 整理故事 / 取標題 / 一般對話的引導回覆（純文字 LLM 呼叫）用另一個池，不會排在一堆生圖工作後面
+STORY_WORKERS = int(os.environ.get("STORY_WORKERS", "8"))
+story_executor = ThreadPoolExecutor(max_workers=STORY_WORKERS, thread_name_prefix="story")
 log.info("🚀 app boot: public GCS URL mode (Uniform access + bucket public)")
 
+# =============== 重試：指數退避 + jitter（只重試 429 / 5xx / 連線錯誤） ===============
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 0.1    # 秒
+RETRY_MAX_DELAY = 10.0
+RETRYABLE_STATUS = {429, 500, 502, 503, 504}
+
+def _is_retryable(exc) -> bool:
+    # OpenAI 例外帶 status_code；google.api_core 例外的 code 是 HTTP 狀態碼
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return type(exc).__name__ in ("APIConnectionError", "APITimeoutError", "ConnectionError", "Timeout")
+
+def call_with_backoff(fn, what: str):
+    for attempt in range(RETRY_ATTEMPTS):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == RETRY_ATTEMPTS - 1 or not _is_retryable(e):
+                raise
+            delay = min(RETRY_BASE_DELAY * (2 ** attempt), RETRY_MAX_DELAY) * (0.5 + random.random())
+            log.warning("🔁 %s retry %d/%d in %.2fs: %s", what, attempt + 1, RETRY_ATTEMPTS - 1, delay, e)
+            time.sleep(delay)
+
+# =============== 速率限制：token bucket（行程內共用） ===============
+# 併發一高所有執行緒會同時打 OpenAI，先在本地排隊，避免一起吃 429 再一起重試
+class RateLimiter:
+    def __init__(self, per_minute: int):
+        self.rate = per_minute / 60.0          # 每秒補充的 token
+        self.capacity = max(1, per_minute)     # 允許的瞬間爆量
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+OPENAI_CHAT_RPM = int(os.environ.get("OPENAI_CHAT_RPM", "500"))
+OPENAI_IMAGE_RPM = int(os.environ.get("OPENAI_IMAGE_RPM", "50"))
+chat_limiter = RateLimiter(OPENAI_CHAT_RPM)
+image_limiter = RateLimiter(OPENAI_IMAGE_RPM)
+
 # =============== Firebase / Firestore（容錯） ===============
 import firebase_admin
 from firebase_admin import credentials, firestore
-from google.cloud import storage as gcs_storage
-from google.api_core.exceptions import GoogleAPIError
+from google.api_core.exceptions import GoogleAPIError, PreconditionFailed
+from google.api_core import retry as gapi_retry
 
 FIREBASE_CREDENTIALS = os.environ.get("FIREBASE_CREDENTIALS")
 FIREBASE_PROJECT_ID = os.environ.get("FIREBASE_PROJECT_ID") or os.environ.get("GOOGLE_CLOUD_PROJECT")
@@ -50,7 +174,7 @@ def _init_firebase():
         cred = None
         if FIREBASE_CREDENTIALS:
             try:
-                cred = credentials.Certificate(json.loads(FIREBASE_CREDENTIALS))
+                cred = credentials.Certificate(orjson.loads(FIREBASE_CREDENTIALS))
                 log.info("✅ Firebase: using inline service account JSON")
             except Exception as e:
                 log.warning("⚠️ FIREBASE_CREDENTIALS invalid: %s", e)
@@ -65,17 +189,53 @@ def _init_firebase():
 
 db = _init_firebase()
 
+# =============== Redis（選用：多 worker / 多 instance 共用 session） ===============
+REDIS_URL = os.environ.get("REDIS_URL")
+SESSION_TTL = int(os.environ.get("SESSION_TTL", "86400"))   # 秒；每次讀取都會續期
+
+def _init_redis():
+    if not REDIS_URL:
+        log.info("ℹ️ REDIS_URL not set; sessions stay in process memory")
+        return None
+    try:
+        import redis
+        client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+        client.ping()
+        log.info("✅ Redis session store connected")
+        return client
+    except Exception as e:
+        log.error("❌ Redis init failed: %s", e)
+        return None
+
+rds = _init_redis()
+
 # =============== GCS（Uniform + 公開讀取） ===============
-gcs_client = gcs_storage.Client()
-gcs_bucket = gcs_client.bucket(GCS_BUCKET)
+# 第一次上傳時才建立 client（google.cloud.storage 載入與認證都慢），之後重用同一個 bucket
+@functools.lru_cache(maxsize=1)
+def _gcs_bucket():
+    from google.cloud import storage as gcs_storage
+    return gcs_storage.Client().bucket(GCS_BUCKET)
 
 def gcs_upload_bytes(data: bytes, filename: str, content_type: str = "image/png"):
     t0 = time.time()
     try:
-        blob = gcs_bucket.blob(filename)
+        bucket = _gcs_bucket()
+        blob = bucket.blob(filename)
         blob.cache_control = "public, max-age=31536000"
-        blob.upload_from_string(data, content_type=content_type)
-        url = f"https://storage.googleapis.com/{gcs_bucket.name}/{filename}"
+        # 檔名都帶隨機碼，if_generation_match=0 可避免覆寫，也讓 GCS client 的內建重試生效；
+        # 重試交給 client 就好，外面再包一層退避只會疊加重試次數
+        url = f"https://storage.googleapis.com/{bucket.name}/{filename}"
+        try:
+            blob.upload_from_file(BytesIO(data), size=len(data), content_type=content_type,
+                                  rewind=False, if_generation_match=0)
+        except PreconditionFailed:
+            # 前一次嘗試其實已寫入、只是 client 逾時沒收到回應，重試時才撞到 412。
+            # 檔名帶完整 uuid 幾乎不可能撞名，仍比對 md5 確認 bucket 裡的就是這次的圖才算成功
+            blob.reload()
+            if blob.md5_hash != b64encode(hashlib.md5(data).digest()).decode():
+                log.error("❌ GCS object name collision | name=%s", filename)
+                return None
+            log.info("☁️ GCS object already exists (earlier attempt landed) | name=%s", filename)
         log.info("☁️ GCS upload ok | ms=%d | name=%s | bytes=%d | url=%s",
                  int((time.time()-t0)*1000), filename, len(data or b""), url)
         return url
@@ -86,24 +246,157 @@ def gcs_upload_bytes(data: bytes, filename: str, content_type: str = "image/png"
     return None
 
 # =============== OpenAI 初始化 ===============
-_openai_mode = None
 _oai_client = None
+OPENAI_TIMEOUT = float(os.environ.get("OPENAI_TIMEOUT", "120"))   # 秒
 
 def _init_openai():
-    global _openai_mode, _oai_client
+    global _oai_client
     try:
-        from openai import OpenAI
-        _oai_client = OpenAI(api_key=OPENAI_API_KEY)
-        _openai_mode = "sdk1"
-        log.info("✅ OpenAI init: sdk1")
-    except Exception:
-        import openai
-        openai.api_key = OPENAI_API_KEY
-        _oai_client = openai
-        _openai_mode = "legacy"
-        log.info("✅ OpenAI init: legacy")
+        from openai import OpenAI, DefaultHttpxClient
+        import httpx
+        # 共用一個 HTTP/2 連線池：chat 與生圖請求在同一條連線上多工，不用每次重新握手
+        _oai_client = OpenAI(
+            api_key=OPENAI_API_KEY,
+            # SDK 預設 timeout 是 600 秒；連線卡住時不要佔住執行緒十分鐘（生圖通常一分鐘內完成）
+            timeout=httpx.Timeout(OPENAI_TIMEOUT, connect=10.0),
+            http_client=DefaultHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=50, max_keepalive_connections=20),
+            ),
+        )
+        log.info("✅ OpenAI init")
+    except Exception as e:
+        log.error("❌ OpenAI init failed: %s", e)
+
+# 延遲初始化：openai 套件（pydantic / httpx …）很重，等第一次真正呼叫時才載入，縮短冷啟動
+_openai_lock = threading.Lock()
+
+def _ensure_openai():
+    if _oai_client is None:
+        with _openai_lock:
+            if _oai_client is None:
+                _init_openai()
+    return _oai_client
+
+CHAT_MODEL = "gpt-4o-mini"
+
+# =============== LLM 回應快取（正規化後相同的請求才命中） ===============
+# 只快取低溫度（幾乎是確定性輸出）的呼叫；高溫度的引導 / 標題本來就希望每次不一樣。
+# 不做 embedding 相似度比對：摘要 / 角色分析是針對每個人自己的故事，「很像」的故事套用別人的答案會出錯
+LLM_CACHE_MAX = int(os.environ.get("LLM_CACHE_MAX", "2048"))
+LLM_CACHE_MAX_TEMPERATURE = 0.3
+LLM_CACHE_TTL = int(os.environ.get("LLM_CACHE_TTL", str(4 * 3600)))   # 秒；Redis / Firestore 讓重啟後與其他 worker 也能命中
+# Firestore 這一層要呼叫端指定 persist=True 才查：每句話都跑的角色分析幾乎都不會命中，不該每次多一趟 Firestore 讀取
+_llm_cache = OrderedDict()   # key -> (text, expires_at epoch)
+_llm_cache_lock = threading.Lock()
+
+_RE_WHITESPACE = re.compile(r"\s+")
+
+def _normalize_for_cache(text: str) -> str:
+    # 全形 / 半形標點（「！」和「!」）、多餘的空白與換行都不影響答案，正規化後同一個 key
+    return _RE_WHITESPACE.sub(" ", unicodedata.normalize("NFKC", text)).strip()
+
+def _llm_cache_key(messages, temperature, kwargs) -> str:
+    normalized = [{**m, "content": _normalize_for_cache(m.get("content") or "")} for m in messages]
+    raw = orjson.dumps([CHAT_MODEL, temperature, normalized, kwargs], option=orjson.OPT_SORT_KEYS)
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _llm_cache_remember(key: str, text: str, expires_at: float = None):
+    with _llm_cache_lock:
+        _llm_cache[key] = (text, expires_at or time.time() + LLM_CACHE_TTL)
+        _llm_cache.move_to_end(key)
+        while len(_llm_cache) > LLM_CACHE_MAX:
+            _llm_cache.popitem(last=False)
+
+def llm_cache_get(key: str, persist: bool = False):
+    # 記憶體 → Redis →（persist 時）Firestore，和生圖快取同樣的三層
+    with _llm_cache_lock:
+        hit = _llm_cache.get(key)
+        if hit:
+            text, expires_at = hit
+            if expires_at > time.time():
+                _llm_cache.move_to_end(key)
+                return text, "memory"
+            del _llm_cache[key]
+    if rds:
+        try:
+            text = rds.get(f"llm:{key}")
+            if text:
+                _llm_cache_remember(key, text)
+                return text, "redis"
+        except Exception as e:
+            log.warning("⚠️ llm_cache redis lookup failed: %s", e)
+    if not (persist and db): return None, None
+    try:
+        doc = db.collection("llm_cache").document(key).get()
+        if doc.exists:
+            d = doc.to_dict() or {}
+            text, expires_at = d.get("reply"), d.get("expires_at")
+            if text and expires_at and expires_at > datetime.now(timezone.utc):
+                _llm_cache_remember(key, text, expires_at.timestamp())
+                return text, "firestore"
+    except Exception as e:
+        log.warning("⚠️ llm_cache lookup failed: %s", e)
+    return None, None
 
-_init_openai()
+def llm_cache_put(key: str, text: str, persist: bool = False):
+    _llm_cache_remember(key, text)
+    if rds:
+        try:
+            rds.set(f"llm:{key}", text, ex=LLM_CACHE_TTL)
+        except Exception as e:
+            log.warning("⚠️ llm_cache redis save failed: %s", e)
+    if not (persist and db): return
+    try:
+        # expires_at 可設成 Firestore TTL policy 的欄位；寫入交給背景批次
+        _fs_queue.put((db.collection("llm_cache").document(key), {
+            "reply": text, "ts": firestore.SERVER_TIMESTAMP,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=LLM_CACHE_TTL),
+        }))
+    except Exception as e:
+        log.warning("⚠️ llm_cache save failed: %s", e)
+
+def _chat(messages, temperature: float, cache: bool = None, persist: bool = False, **kwargs) -> str:
+    """
+    呼叫 chat completion 並回傳去頭尾空白的文字；錯誤交給呼叫端處理。
+    cache 未指定時只快取低溫度的呼叫；指定 True 表示同樣的輸入沿用同一個答案即可。
+    persist=True 時快取也查 / 寫 Firestore（較慢，只給不常呼叫、容易重複命中的請求用）。
+    """
+    cache_key = None
+    if cache if cache is not None else temperature <= LLM_CACHE_MAX_TEMPERATURE:
+        cache_key = _llm_cache_key(messages, temperature, kwargs)
+        hit, tier = llm_cache_get(cache_key, persist)
+        if hit is not None:
+            log.info("♻️ llm cache HIT | tier=%s | key=%s", tier, cache_key[:12])
+            return hit
+        log.info("🔎 llm cache MISS | key=%s", cache_key[:12])
+
+    client = _ensure_openai()
+    if client is None:
+        raise RuntimeError("OpenAI client unavailable")
+    chat_limiter.acquire()
+    resp = client.chat.completions.create(
+        model=CHAT_MODEL, messages=messages, temperature=temperature, **kwargs
+    )
+    text = resp.choices[0].message.content.strip()
+
+    if cache_key:
+        llm_cache_put(cache_key, text, persist)
+    return text
+
+# 送進模型的對話內容以字數設上限（中文大約一字一 token），長對話不會讓 prompt 與延遲一路變大
+PROMPT_CHAR_BUDGET = int(os.environ.get("PROMPT_CHAR_BUDGET", "2000"))
+
+def _trim_to_budget(items: list, budget: int = PROMPT_CHAR_BUDGET, size=len) -> list:
+    """由最新往回保留，總字數超過 budget 就丟掉更舊的；最新一則一定保留。"""
+    kept, total = [], 0
+    for item in reversed(items):
+        total += size(item)
+        if kept and total > budget:
+            break
+        kept.append(item)
+    kept.reverse()
+    return kept
 
 ALLOWED_SIZES = {"1024x1024", "1024x1536", "1536x1024", "512x512", "auto"}
 
@@ -114,6 +407,13 @@ def _normalize_size(size: str) -> str:
         return "512x512"
     return size
 
+def _download_bytes(url: str) -> bytes:
+    # stream=True 直接從 socket 讀成一個 bytes，不經過 r.content 先切塊再 join 的兩倍記憶體；
+    # with 結束就把連線還給連線池
+    with HTTP.get(url, stream=True, timeout=120) as r:
+        r.raise_for_status()
+        return r.raw.read(decode_content=True)
+
 def openai_images_generate(prompt: str, size: str):
     size = _normalize_size(size)
     try:
@@ -121,36 +421,32 @@ def openai_images_generate(prompt: str, size: str):
         log.info("🖼️ images.generate start | size=%s | prompt_len=%d", size, len(prompt))
         img_bytes = None
 
-        if _openai_mode == "sdk1":
-            resp = _oai_client.images.generate(
-                model="gpt-image-1",
-                prompt=prompt,
-                size=size,
-            )
-            datum = resp.data[0]
-            b64 = getattr(datum, "b64_json", None)
-            if b64:
-                import base64
-                img_bytes = base64.b64decode(b64)
-            elif getattr(datum, "url", None):
-                r = requests.get(datum.url, timeout=120)
-                r.raise_for_status()
-                img_bytes = r.content
-        else:
-            resp = _oai_client.Image.create(
-                model="gpt-image-1",
+        client = _ensure_openai()
+        if client is None:
+            raise RuntimeError("OpenAI client unavailable")
+        extra_args = {"output_compression": IMAGE_COMPRESSION} if IMAGE_FORMAT == "jpeg" else {}
+        # 關掉 SDK 自己的重試，統一由 call_with_backoff 處理，避免重試次數相乘
+        images = client.with_options(max_retries=0).images
+
+        def _generate():
+            # 每次嘗試（含重試）都先拿 token
+            image_limiter.acquire()
+            return images.generate(
+                model=IMAGE_MODEL,
                 prompt=prompt,
                 size=size,
+                quality=IMAGE_QUALITY,
+                output_format=IMAGE_FORMAT,
+                **extra_args,
             )
-            d0 = resp["data"][0]
-            b64 = d0.get("b64_json")
-            if b64:
-                import base64
-                img_bytes = base64.b64decode(b64)
-            elif d0.get("url"):
-                r = requests.get(d0["url"], timeout=120)
-                r.raise_for_status()
-                img_bytes = r.content
+
+        resp = call_with_backoff(_generate, "images.generate")
+        datum = resp.data[0]
+        b64 = getattr(datum, "b64_json", None)
+        if b64:
+            img_bytes = b64decode(b64)
+        elif getattr(datum, "url", None):
+            img_bytes = _download_bytes(datum.url)
 
         if not img_bytes:
             log.error("💥 images.generate: no image content in response.")
@@ -163,19 +459,99 @@ def openai_images_generate(prompt: str, size: str):
         log.exception("💥 images.generate error: %s", e)
         return None
 
+# =============== 生圖快取（prompt hash → GCS URL） ===============
+# 同樣的 prompt + size 直接回傳已上傳的圖，省掉 OpenAI 生圖與 GCS 上傳
+# 查詢順序：行程記憶體 → Redis（跨 instance）→ Firestore（冷啟動後仍可命中），都有 7 天 TTL
+IMAGE_CACHE_MAX = int(os.environ.get("IMAGE_CACHE_MAX", "512"))
+IMAGE_CACHE_TTL = int(os.environ.get("IMAGE_CACHE_TTL", str(7 * 24 * 3600)))   # 秒
+_image_cache = OrderedDict()   # key -> (url, expires_at epoch)
+_image_cache_lock = threading.Lock()
+
+def _image_cache_key(prompt: str, size: str) -> str:
+    # 輸出格式、模型、品質也算進 key：同一個 prompt 換了設定就是不同的圖
+    return hashlib.blake2b(f"{prompt}|{size}|{IMAGE_FORMAT}|{IMAGE_MODEL}|{IMAGE_QUALITY}".encode("utf-8"), digest_size=16).hexdigest()
+
+def _image_cache_remember(key: str, url: str, expires_at: float = None):
+    with _image_cache_lock:
+        _image_cache[key] = (url, expires_at or time.time() + IMAGE_CACHE_TTL)
+        _image_cache.move_to_end(key)
+        while len(_image_cache) > IMAGE_CACHE_MAX:
+            _image_cache.popitem(last=False)
+
+def image_cache_get(key: str):
+    with _image_cache_lock:
+        hit = _image_cache.get(key)
+        if hit:
+            url, expires_at = hit
+            if expires_at > time.time():
+                _image_cache.move_to_end(key)
+                return url
+            del _image_cache[key]
+    if rds:
+        try:
+            url = rds.get(f"img:{key}")
+            if url:
+                _image_cache_remember(key, url)
+                return url
+        except Exception as e:
+            log.warning("⚠️ image_cache redis lookup failed: %s", e)
+    if not db: return None
+    try:
+        doc = db.collection("image_cache").document(key).get()
+        if doc.exists:
+            d = doc.to_dict() or {}
+            url, expires_at = d.get("url"), d.get("expires_at")
+            if url and (expires_at is None or expires_at > datetime.now(timezone.utc)):
+                _image_cache_remember(key, url, expires_at.timestamp() if expires_at else None)
+                return url
+    except Exception as e:
+        log.warning("⚠️ image_cache lookup failed: %s", e)
+    return None
+
+def image_cache_put(key: str, url: str):
+    _image_cache_remember(key, url)
+    if rds:
+        try:
+            rds.set(f"img:{key}", url, ex=IMAGE_CACHE_TTL)
+        except Exception as e:
+            log.warning("⚠️ image_cache redis save failed: %s", e)
+    if not db: return
+    try:
+        # expires_at 可直接設成 Firestore TTL policy 的欄位，過期文件自動刪除
+        # 交給背景批次寫入，和同一時間窗的對話紀錄併成一次 commit
+        _fs_queue.put((db.collection("image_cache").document(key), {
+            "url": url, "created_at": firestore.SERVER_TIMESTAMP,
+            "expires_at": datetime.now(timezone.utc) + timedelta(seconds=IMAGE_CACHE_TTL),
+        }))
+    except Exception as e:
+        log.warning("⚠️ image_cache save failed: %s", e)
+
 # --- 角色卡類別 ---
 class CharacterCard:
     def __init__(self, name="無名氏"):
         self.name = name
         self.features = {}
+        self._prompt = None   # render_prompt 的快取，特徵有變動才重組
     
     def update(self, key, value):
-        if value:
+        # 只有值真的變了才回傳 True，呼叫端據此決定要不要寫回儲存
+        if value and self.features.get(key) != value:
             self.features[key] = value
+            self._prompt = None
             return True
         return False
+
+    def to_dict(self):
+        # 只輸出要存進 Redis / Firestore 的欄位，不含快取
+        return {"name": self.name, "features": self.features}
         
     def render_prompt(self):
+        # 同一個角色在 5 段插圖裡會被組很多次，沒變就直接回傳上次的結果
+        if self._prompt is None:
+            self._prompt = self._build_prompt()
+        return self._prompt
+
+    def _build_prompt(self):
         parts = []
         
         # 處理名稱與角色種類
@@ -239,68 +615,232 @@ class CharacterCard:
 
 
 # =============== 會話記憶（含角色卡） ===============
-user_sessions = {}
-user_seeds    = {}
+# LRU + 閒置逾時：只保留最近活躍的 MAX_SESSIONS 位使用者，避免長時間運行的 instance 記憶體一路長大
+MAX_SESSIONS = int(os.environ.get("MAX_SESSIONS", "10000"))
+user_sessions = OrderedDict()   # user_id -> session dict（seed 也放在裡面，一次查表拿到全部狀態）
+_sessions_lock = threading.Lock()   # 只保護 user_sessions 本身的新增 / 移除
+# 每個 session 另有自己的 sess["_lock"]（RLock）：webhook 執行緒、角色分析 timer、生圖背景工作
+# 會同時讀寫同一份 messages / characters，走訪或修改前都要先拿這把鎖
+
+MAX_MESSAGES = 60   # 每位使用者最多保留的對話則數（記憶體與 Redis 都一樣）
 
 def _ensure_session(user_id):
-    # 新增 story_mode 預設值
-    sess = user_sessions.setdefault(user_id, {
-        "messages": [],
-        "paras": [],
-        "characters": {},
-        "story_id": None,
-        "story_title": None,
-        "story_mode": False   # <<< 新增：是否進入故事模式
-    })
-    user_seeds.setdefault(user_id, random.randint(100000, 999999))
-    if sess.get("story_id") is None:
-        sess["story_id"] = f"story-{int(time.time())}-{random.randint(1000,9999)}"
+    with _sessions_lock:
+        # 新增 story_mode 預設值
+        sess = user_sessions.setdefault(user_id, {
+            "messages": deque(maxlen=MAX_MESSAGES),
+            "paras": [],
+            "characters": {},
+            "story_id": None,
+            "story_title": None,
+            "story_mode": False,   # <<< 新增：是否進入故事模式
+            "_lock": threading.RLock(),
+        })
+        if not sess.get("seed"):
+            sess["seed"] = random.randint(100000, 999999)
+        now = time.time()
+        sess["_last_seen"] = now
+        user_sessions.move_to_end(user_id)
+        # 最前面的就是最久沒出現的使用者：超過上限或閒置超過 SESSION_TTL 就移出記憶體。
+        # 故事本體每次變動都已寫進 Redis / Firestore，回來時會重新載入
+        while user_sessions:
+            oldest = next(iter(user_sessions.values()))
+            if len(user_sessions) <= MAX_SESSIONS and now - oldest.get("_last_seen", now) <= SESSION_TTL:
+                break
+            user_sessions.popitem(last=False)
+    if rds and _redis_load_session(user_id, sess):
+        sess["_story_loaded"] = True
+    # Firestore 只在這個 session 第一次使用時讀一次，之後以記憶體（或 Redis）為準
+    if not sess.get("_story_loaded"):
+        load_current_story(user_id, sess)
+        sess["_story_loaded"] = True
+    with sess["_lock"]:
+        if sess.get("story_id") is None:
+            sess["story_id"] = f"story-{int(time.time())}-{random.randint(1000,9999)}"
     return sess
 
+def _characters_to_dict(characters: dict) -> dict:
+    return {k: v.to_dict() for k, v in characters.items()}
+
+def _characters_from_dict(data: dict) -> dict:
+    characters = {}
+    for name, char_dict in (data or {}).items():
+        card = CharacterCard(name=name)
+        card.name = char_dict.get("name", name)
+        card.features = dict(char_dict.get("features") or {})
+        characters[name] = card
+    return characters
+
+def _redis_load_session(user_id, sess) -> bool:
+    # 每次都以 Redis 為準，其他 worker / instance 的更新才看得到；回傳是否有故事快照
+    try:
+        # 快照、訊息、seed 與續期一次 pipeline 送出，只花一個 RTT
+        pipe = rds.pipeline(transaction=False)
+        pipe.get(f"sess:{user_id}")
+        pipe.lrange(f"sess:{user_id}:messages", -MAX_MESSAGES, -1)
+        pipe.set(f"seed:{user_id}", sess["seed"], nx=True, ex=SESSION_TTL)
+        pipe.get(f"seed:{user_id}")
+        pipe.expire(f"sess:{user_id}", SESSION_TTL)
+        pipe.expire(f"sess:{user_id}:messages", SESSION_TTL)
+        raw, raw_msgs, _, seed, _, _ = pipe.execute()
+        with sess["_lock"]:
+            if raw:
+                d = orjson.loads(raw)
+                sess["story_mode"] = d.get("story_mode", False)
+                sess["story_id"] = d.get("story_id") or sess.get("story_id")
+                sess["story_title"] = d.get("story_title")
+                sess["paras"] = d.get("paras") or []
+                sess["characters"] = _characters_from_dict(d.get("characters"))
+                sess["_summary_key"] = d.get("summary_key")
+            sess["messages"] = deque((orjson.loads(m) for m in raw_msgs), maxlen=MAX_MESSAGES)
+            if seed:
+                sess["seed"] = int(seed)
+        return bool(raw)
+    except Exception as e:
+        log.warning("⚠️ redis load session failed: %s", e)
+        return False
+
+def _redis_save_session(user_id, sess):
+    if not rds: return
+    try:
+        with sess["_lock"]:
+            payload = orjson.dumps({
+                "story_mode": sess.get("story_mode", False),
+                "story_id": sess.get("story_id"),
+                "story_title": sess.get("story_title"),
+                "paras": sess.get("paras", []),
+                "characters": _characters_to_dict(sess.get("characters", {})),
+                # 摘要快取的 key 也一起共用：A worker 整理過的故事，B worker 再收到「整理」可直接沿用
+                "summary_key": sess.get("_summary_key"),
+            })
+        rds.setex(f"sess:{user_id}", SESSION_TTL, payload)
+    except Exception as e:
+        log.warning("⚠️ redis save session failed: %s", e)
+
+def append_message(user_id, sess, role, content):
+    msg = {"role": role, "content": content}
+    with sess["_lock"]:
+        sess["messages"].append(msg)   # deque(maxlen) 會自動丟掉最舊的一則
+    if not rds: return
+    try:
+        key = f"sess:{user_id}:messages"
+        pipe = rds.pipeline(transaction=False)
+        pipe.rpush(key, orjson.dumps(msg))
+        pipe.ltrim(key, -MAX_MESSAGES, -1)
+        pipe.expire(key, SESSION_TTL)
+        pipe.execute()
+    except Exception as e:
+        log.warning("⚠️ redis append message failed: %s", e)
+
+# =============== Firestore 背景批次寫入 ===============
+# 對話紀錄、故事存檔都不需要等寫入完成：丟進 queue，由背景執行緒每 250ms（或湊滿 20 筆）合併成一個 WriteBatch
+FIRESTORE_FLUSH_INTERVAL = float(os.environ.get("FIRESTORE_FLUSH_INTERVAL", "0.25"))
+FIRESTORE_FLUSH_AT = int(os.environ.get("FIRESTORE_FLUSH_AT", "20"))   # 湊滿就先送，不等時間窗
+FIRESTORE_BATCH_MAX = 500   # Firestore 單一 batch 上限
+# 重試交給 Firestore client（只重試暫時性錯誤），外面不再包一層退避；
+# 總時間設上限，寫入執行緒不會被一個卡住的 batch 綁太久、queue 一路變長
+FIRESTORE_COMMIT_TIMEOUT = float(os.environ.get("FIRESTORE_COMMIT_TIMEOUT", "20"))
+FIRESTORE_COMMIT_RETRY = gapi_retry.Retry(initial=0.1, maximum=2.0, multiplier=2.0, timeout=FIRESTORE_COMMIT_TIMEOUT)
+_fs_queue = queue.Queue()
+
+def _firestore_writer():
+    while True:
+        ops = [_fs_queue.get()]
+        deadline = time.time() + FIRESTORE_FLUSH_INTERVAL
+        while len(ops) < min(FIRESTORE_FLUSH_AT, FIRESTORE_BATCH_MAX):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                ops.append(_fs_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        _commit_ops(ops)
+
+def _commit_ops(ops):
+    # 同一個文件（例如 story/current）在時間窗內被存了好幾次，只送最後一版
+    latest = {}
+    for doc_ref, data in ops:
+        latest.pop(doc_ref.path, None)
+        latest[doc_ref.path] = (doc_ref, data)
+    try:
+        batch = db.batch()
+        for doc_ref, data in latest.values():
+            batch.set(doc_ref, data)
+        # 文件 ID 都是 client 端產生的、寫法是 set，重送同一個 batch 不會多寫出重複資料
+        batch.commit(retry=FIRESTORE_COMMIT_RETRY, timeout=FIRESTORE_COMMIT_TIMEOUT)
+        log.info("🗂️ Firestore batch commit | writes=%d | queued=%d", len(latest), len(ops))
+    except Exception as e:
+        log.warning("⚠️ Firestore batch commit failed | writes=%d | queued=%d | %s", len(latest), len(ops), e)
+
+def _flush_firestore_queue():
+    # 行程結束（gunicorn 收到 SIGTERM、Cloud Run 縮容）時把 queue 裡還沒寫的對話紀錄同步寫完
+    ops = []
+    while True:
+        try:
+            ops.append(_fs_queue.get_nowait())
+        except queue.Empty:
+            break
+    for i in range(0, len(ops), FIRESTORE_BATCH_MAX):
+        _commit_ops(ops[i:i + FIRESTORE_BATCH_MAX])
+
+if db:
+    threading.Thread(target=_firestore_writer, name="firestore-writer", daemon=True).start()
+    atexit.register(_flush_firestore_queue)
+
 def save_chat(user_id, role, text):
-    if not db: return
     try:
         doc_ref = db.collection("users").document(user_id).collection("chat").document()
-        doc_ref.set({
-            "role": role, "text": text, "timestamp": firestore.SERVER_TIMESTAMP
-        })
+        # 同一個 batch 裡的文件 SERVER_TIMESTAMP 都一樣，另外帶 client 端的奈秒時間，連續好幾句也排得出先後
+        _fs_queue.put((doc_ref, {
+            "role": role, "text": text, "timestamp": firestore.SERVER_TIMESTAMP,
+            "client_ts_ns": time.time_ns(),
+        }))
     except Exception as e:
         log.warning("⚠️ save_chat failed: %s", e)
 
 def save_current_story(user_id, sess):
-    if not db: return
+    _redis_save_session(user_id, sess)
+    _save_story_doc(user_id, sess)
+
+def _save_story_doc(user_id, sess):
     try:
-        char_data = {k: v.__dict__ for k, v in sess.get("characters", {}).items()}
-        
-        doc = {
-            "story_id": sess.get("story_id"),
-            "paragraphs": sess.get("paras", []),
-            "characters": char_data,
-            "story_title": sess.get("story_title"), # 保存故事標題
-            "updated_at": firestore.SERVER_TIMESTAMP
-        }
-        db.collection("users").document(user_id).collection("story").document("current").set(doc)
+        with sess["_lock"]:
+            doc = {
+                "story_id": sess.get("story_id"),
+                "paragraphs": list(sess.get("paras", [])),
+                "characters": _characters_to_dict(sess.get("characters", {})),
+                "story_title": sess.get("story_title"), # 保存故事標題
+                "updated_at": firestore.SERVER_TIMESTAMP
+            }
+        doc_ref = db.collection("users").document(user_id).collection("story").document("current")
+        # Firestore 只在 session 第一次建立時讀回（_story_loaded），晚幾百毫秒落地不影響本行程；
+        # 跨 worker 的即時狀態由上面同步寫的 Redis 負責
+        _fs_queue.put((doc_ref, doc))
     except Exception as e:
         log.warning("⚠️ save_current_story failed: %s", e)
 
 def load_current_story(user_id, sess):
-    if not db: return
     try:
         doc = db.collection("users").document(user_id).collection("story").document("current").get()
         if doc.exists:
             d = doc.to_dict() or {}
-            sess["story_id"] = d.get("story_id") or sess.get("story_id")
-            sess["paras"] = d.get("paragraphs") or sess.get("paras", [])
-            sess["story_title"] = d.get("story_title") or sess.get("story_title") # 載入故事標題
-            
-            loaded_chars = d.get("characters", {})
-            for name, char_dict in loaded_chars.items():
-                card = CharacterCard(name=name)
-                card.__dict__.update(char_dict)
-                sess["characters"][name] = card
+            with sess["_lock"]:
+                sess["story_id"] = d.get("story_id") or sess.get("story_id")
+                sess["paras"] = d.get("paragraphs") or sess.get("paras", [])
+                sess["story_title"] = d.get("story_title") or sess.get("story_title") # 載入故事標題
+                
+                sess["characters"].update(_characters_from_dict(d.get("characters", {})))
     except Exception as e:
         log.warning("⚠️ load_current_story failed: %s", e)
 
+# Firestore 初始化失敗時，載入時就把純 Firestore 的讀寫換成 no-op，不必每次呼叫都檢查 db
+def _firestore_disabled(*args, **kwargs):
+    return None
+
+if db is None:
+    save_chat = _save_story_doc = load_current_story = _firestore_disabled
+
 
 def maybe_update_character_card(sess, user_id, text):
     """
@@ -309,7 +849,7 @@ def maybe_update_character_card(sess, user_id, text):
     if not sess.get("story_mode", False):
         log.info(f"🚫 Skip character update | user={user_id} | story_mode=False")
         return
-    if not _oai_client or not text.strip():
+    if not text.strip() or not _ensure_openai():
         return
     
     sysmsg = f"""
@@ -320,13 +860,13 @@ def maybe_update_character_card(sess, user_id, text):
     1. 識別句子中是否提到了**明確的角色名稱**（例如：小明、小狗、一隻貓）。名稱可以是人名、動物名或任何具體稱謂。
     2. 提取與該角色相關的**外觀特徵**（如：髮色、髮型、衣服顏色、穿著、配件等）和**物種**（例如：男孩、女孩、狗、貓、機器人）。
     3. **服裝請盡可能拆解為「顏色」和「種類」兩個部分。例如，「白色的長裙」應識別為 `top_color: "white"` 和 `top_type: "long dress"`。如果沒有明確的上下身區分，可以使用 `clothing_color` 和 `clothing_type`。**
-    4. 請將分析結果以**JSON 列表**格式輸出，不要有任何額外的文字或解釋。
-    5. 每個 JSON 物件必須包含 `name` 和 `features` 欄位。
+    4. 請只輸出一個 JSON 物件，格式為 `{{"characters": [...]}}`，不要有任何額外的文字或解釋；沒有角色就回 `{{"characters": []}}`。
+    5. `characters` 裡每個 JSON 物件必須包含 `name` 和 `features` 欄位。
       - `name` 欄位必須是從句子中提取的具體名稱。
       - `features` 字典中的 key 應為英文，value 為英文或簡潔中文。
       - 例：
-        [{{"name": "小明", "features": {{"species": "boy", "hair_color": "black", "clothing_color": "blue", "clothing_type": "T-shirt"}}}},
-         {{"name": "可可", "features": {{"species": "fox", "color": "white"}}}}]
+        {{"characters": [{{"name": "小明", "features": {{"species": "boy", "hair_color": "black", "clothing_color": "blue", "clothing_type": "T-shirt"}}}},
+                        {{"name": "可可", "features": {{"species": "fox", "color": "white"}}}}]}}
 
     用戶輸入：{text}
     """
@@ -334,67 +874,91 @@ def maybe_update_character_card(sess, user_id, text):
     try:
         t0 = time.time()
         
-        if _openai_mode == "sdk1":
-            resp = _oai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.3,
-            )
-            result_text = resp.choices[0].message.content.strip()
-        else:
-            resp = _oai_client.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.3,
-            )
-            result_text = resp["choices"][0]["message"]["content"].strip()
+        # JSON mode 保證回傳合法的 JSON 物件，不再需要從雜訊裡亂抓名字建立假角色
+        result_text = _chat([{"role": "system", "content": sysmsg}], temperature=0.3,
+                            response_format={"type": "json_object"})
         
         try:
-            # 嘗試解析 JSON
-            json_data = json.loads(result_text)
-            if not isinstance(json_data, list):
-                json_data = [json_data]
-        
-        except json.JSONDecodeError:
-            log.warning(f"⚠️ LLM did not return valid JSON. Response: {result_text}")
-            # fallback: 嘗試抓名字建立角色
-            names = re.findall(r"[A-Za-z\u4e00-\u9fff]{1,4}", result_text)
-            json_data = [{"name": n, "features": {}} for n in names[:3]]  # 最多三個角色
+            json_data = orjson.loads(result_text).get("characters") or []
+        except (orjson.JSONDecodeError, AttributeError):
+            log.warning(f"⚠️ LLM did not return a valid characters object. Response: {result_text}")
+            return
         
-        # 統一處理角色更新/建立
-        for char_obj in json_data:
-            char_name = char_obj.get("name")
-            features = char_obj.get("features", {})
+        # 統一處理角色更新/建立（拿著 session 鎖，生圖背景工作不會讀到改到一半的角色卡）
+        changed = False
+        with sess["_lock"]:
+            for char_obj in json_data:
+                char_name = char_obj.get("name")
+                features = char_obj.get("features", {})
     
-            if not char_name:
-                log.warning("❌ LLM output did not contain a name in a character object.")
-                continue
+                if not char_name:
+                    log.warning("❌ LLM output did not contain a name in a character object.")
+                    continue
     
-            if char_name in sess["characters"]:
-                char_card = sess["characters"][char_name]
-                for key, value in features.items():
-                    if char_card.update(key, value):
-                        log.info(f"🧬 [LLM] Updated character card | user={user_id} | name={char_name} | key={key} | value={value}")
-            else:
-                new_char_card = CharacterCard(name=char_name)
-                # 先設置默認屬性
-                if "species" not in features:
-                    new_char_card.update("species", "human")
+                if char_name in sess["characters"]:
+                    char_card = sess["characters"][char_name]
+                    for key, value in features.items():
+                        if char_card.update(key, value):
+                            changed = True
+                            log.info(f"🧬 [LLM] Updated character card | user={user_id} | name={char_name} | key={key} | value={value}")
+                else:
+                    new_char_card = CharacterCard(name=char_name)
+                    # 先設置默認屬性
+                    if "species" not in features:
+                        new_char_card.update("species", "human")
                 
-                # 再更新 LLM 提供的特徵
-                for key, value in features.items():
-                    new_char_card.update(key, value)
+                    # 再更新 LLM 提供的特徵
+                    for key, value in features.items():
+                        new_char_card.update(key, value)
                 
-                sess["characters"][char_name] = new_char_card
-                log.info(f"✨ [LLM] New character created | user={user_id} | name={char_name} | features={json.dumps(new_char_card.features, ensure_ascii=False)}")
+                    sess["characters"][char_name] = new_char_card
+                    changed = True
+                    log.info(f"✨ [LLM] New character created | user={user_id} | name={char_name} | features={orjson.dumps(new_char_card.features).decode()}")
 
-        save_current_story(user_id, sess)
+        # 角色卡沒變就不寫 Redis / Firestore，避免每句話都整份故事重寫一次
+        if changed:
+            save_current_story(user_id, sess)
     
     except Exception as e:
         log.error(f"❌ OpenAI character extraction failed: {e}")
 
 
 
+# 使用者常常連續丟好幾句話：同一位使用者在 CHARACTER_DEBOUNCE 秒內的訊息合併成一次角色分析
+CHARACTER_DEBOUNCE = float(os.environ.get("CHARACTER_DEBOUNCE", "2.0"))
+# 這裡不保留 sess 物件：等待期間使用者可能開了新故事，timer 觸發時要重新查目前的 session
+_char_pending = {}   # user_id -> {"story_id": 排程時的故事, "texts": 尚未分析的句子}
+_char_pending_lock = threading.Lock()
+
+def schedule_character_update(sess, user_id, text):
+    story_id = sess.get("story_id")
+    with _char_pending_lock:
+        pending = _char_pending.get(user_id)
+        if pending is not None:
+            if pending["story_id"] == story_id:
+                pending["texts"].append(text)
+            else:
+                # 換了故事：舊故事還沒分析的句子不再需要
+                _char_pending[user_id] = {"story_id": story_id, "texts": [text]}
+            return
+        _char_pending[user_id] = {"story_id": story_id, "texts": [text]}
+    timer = threading.Timer(CHARACTER_DEBOUNCE, _flush_character_update, args=(user_id,))
+    timer.daemon = True
+    timer.start()
+
+def _flush_character_update(user_id):
+    with _char_pending_lock:
+        pending = _char_pending.pop(user_id, None)
+    if not pending or not pending["texts"]:
+        return
+    with _sessions_lock:
+        sess = user_sessions.get(user_id)
+    if sess is None or sess.get("story_id") != pending["story_id"]:
+        # 等待期間開了新故事（或 session 已被移出記憶體），不能把舊故事的角色寫回去蓋掉新故事
+        log.info("🚫 Skip character update | user=%s | story changed while debouncing", user_id)
+        return
+    maybe_update_character_card(sess, user_id, "\n".join(pending["texts"]))
+
 def render_character_card_as_text(characters: dict) -> str:
     if not characters:
         return ""
@@ -441,24 +1005,84 @@ def generate_story_summary(messages, characters_list):
     )
     msgs = [{"role": "system", "content": sysmsg}] + messages
     try:
-        if _openai_mode == "sdk1":
-            resp = _oai_client.chat.completions.create(
-                model="gpt-4o-mini", messages=msgs, temperature=0.5
-            )
-            return resp.choices[0].message.content.strip()
-        else:
-            resp = _oai_client.ChatCompletion.create(
-                model="gpt-4o-mini", messages=msgs, temperature=0.5
-            )
-            return resp["choices"][0]["message"]["content"].strip()
+        return _chat(msgs, temperature=0.5)
     except Exception as e:
         log.error("❌ OpenAI chat error: %s", e)
         return None
 
+def generate_story_summary_with_title(messages, characters_list):
+    """
+    一次呼叫同時拿到 5 段故事與標題（JSON mode），省掉整理後再取標題的第二趟來回。
+    回傳 (summary, paras, title)；解析失敗回傳 None，由呼叫端退回原本兩次呼叫的流程。
+    """
+    char_names_str = "、".join(characters_list) if characters_list else "主角"
+    sysmsg = (
+        f"請將以下對話整理成 5 段完整故事，每段 2–3 句（約 60–120 字）。"
+        f"在故事中，請**盡量使用明確的角色名稱**（例如：{char_names_str}），**不要用「他們」這類代詞**。\n"
+        f"內容應自然呈現場景、角色、主要動作與關鍵物件。\n"
+        f"另外請為故事取一個 8-15 個中文字、反映核心情節的獨特標題，避免「奇妙的故事」等通用詞彙。\n"
+        "請只輸出 JSON 物件，格式為：\n"
+        '{"title": "故事標題", "paragraphs": ["第一段", "第二段", "第三段", "第四段", "第五段"]}'
+    )
+    msgs = [{"role": "system", "content": sysmsg}] + messages
+    try:
+        data = orjson.loads(_chat(msgs, temperature=0.5, response_format={"type": "json_object"}))
+        paras = [str(p).strip() for p in (data.get("paragraphs") or []) if str(p).strip()][:5]
+        if not paras:
+            log.warning("⚠️ summary JSON has no paragraphs")
+            return None
+        summary = "\n".join(f"{i}. {p}" for i, p in enumerate(paras, 1))
+        char_names = ", ".join(characters_list) if characters_list else "主角"
+        title = _clean_story_title(str(data.get("title") or "").strip(), char_names)
+        return summary, paras, title
+    except Exception as e:
+        log.error("❌ OpenAI summary+title error: %s", e)
+        return None
+
+# 一次掃描抓出「1. xxx」格式的各段內容（去掉編號與前後空白）
+_RE_STORY_LINE = re.compile(r"^[ \t]*\d+\.?[ \t]*([^\s.].*?)[ \t\r]*$", re.MULTILINE)
+
+# 只有編號、沒有內容的佔位行（例如「3.」）
+_RE_BARE_NUMBER = re.compile(r"^\d+\.?$")
+
 def extract_paragraphs(summary):
     if not summary: return []
-    lines = [re.sub(r"^\d+\.?\s*", "", x.strip()) for x in summary.split("\n") if x.strip()]
-    return lines[:5]
+    paras = _RE_STORY_LINE.findall(summary)
+    if not paras:
+        # 模型沒照「1. 2. 3.」編號（例如「第一段：…」）時退回逐行切，不要整份摘要都丟掉
+        paras = [ln.strip() for ln in summary.splitlines() if ln.strip() and not _RE_BARE_NUMBER.match(ln.strip())]
+    return paras[:5]
+
+# 標題前後的引號 / 括號
+_RE_TITLE_LEAD = re.compile(r"^['\"「『【（〔〖《＜《「『【〖〔（＜＜]+")
+_RE_TITLE_TRAIL = re.compile(r"['\"」』】）〕〗》＞》」』】〗〕）＞＞]+$")
+# 標題中間殘留的書名號 / 引號一次刪掉，不必連續四次 replace 各掃一遍
+_TITLE_STRIP_TABLE = str.maketrans("", "", "《》「」")
+
+def _clean_story_title(title: str, char_names: str) -> str:
+    # 更強化的標題清理
+    title = _RE_TITLE_LEAD.sub("", title or "")
+    title = _RE_TITLE_TRAIL.sub("", title)
+    title = title.translate(_TITLE_STRIP_TABLE)
+    
+    # 如果標題為空或仍然是通用標題，生成基於角色的預設標題
+    if not title or title in ["奇妙的故事", "故事", "一個故事"]:
+        if char_names and char_names != "主角":
+            # 基於角色名稱生成標題
+            main_chars = char_names.split(", ")[:2]  # 取前兩個角色
+            if len(main_chars) == 1:
+                title = f"{main_chars[0]}的冒險"
+            else:
+                title = f"{main_chars[0]}與{main_chars[1]}的故事"
+        else:
+            # 基於故事內容關鍵字生成標題
+            fallback_titles = [
+                "神奇的冒險", "意想不到的旅程", "夢幻之旅", 
+                "奇遇記", "探險時光", "魔法故事",
+                "童話冒險", "奇幻之旅", "美好時光"
+            ]
+            title = random.choice(fallback_titles)
+    return title
 
 # 新增：生成故事標題
 def _generate_story_title(paragraphs: list, characters: dict) -> str:
@@ -484,49 +1108,14 @@ def _generate_story_title(paragraphs: list, characters: dict) -> str:
     try:
         log.info("🎯 Generating story title for user with characters: %s", char_names)
         
-        if _openai_mode == "sdk1":
-            resp = _oai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.8,  # 提高創意性
-                max_tokens=50,    # 增加token數量確保完整標題
-                top_p=0.9        # 增加多樣性
-            )
-            title = resp.choices[0].message.content.strip()
-        else:
-            resp = _oai_client.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.8,
-                max_tokens=50,
-                top_p=0.9
-            )
-            title = resp["choices"][0]["message"]["content"].strip()
-        
-        # 更強化的標題清理
-        title = re.sub(r"^['\"「『【（〔〖《＜《「『【〖〔（＜＜]+", "", title)
-        title = re.sub(r"['\"」』】）〕〗》＞》」』】〗〕）＞＞]+$", "", title)
-        title = title.replace("《", "").replace("》", "").replace("「", "").replace("」", "")
-        
-        # 如果標題為空或仍然是通用標題，生成基於角色的預設標題
-        if not title or title in ["奇妙的故事", "故事", "一個故事"]:
-            if char_names and char_names != "主角":
-                # 基於角色名稱生成標題
-                main_chars = char_names.split(", ")[:2]  # 取前兩個角色
-                if len(main_chars) == 1:
-                    title = f"{main_chars[0]}的冒險"
-                else:
-                    title = f"{main_chars[0]}與{main_chars[1]}的故事"
-            else:
-                # 基於故事內容關鍵字生成標題
-                import random
-                fallback_titles = [
-                    "神奇的冒險", "意想不到的旅程", "夢幻之旅", 
-                    "奇遇記", "探險時光", "魔法故事",
-                    "童話冒險", "奇幻之旅", "美好時光"
-                ]
-                title = random.choice(fallback_titles)
+        title = _chat(
+            [{"role": "system", "content": sysmsg}],
+            temperature=0.8,  # 提高創意性
+            max_tokens=50,    # 增加token數量確保完整標題
+            top_p=0.9         # 增加多樣性
+        )
         
+        title = _clean_story_title(title, char_names)
         log.info("✅ Generated story title: %s", title)
         return title
 
@@ -541,7 +1130,6 @@ def _generate_story_title(paragraphs: list, characters: dict) -> str:
             else:
                 return f"{main_chars[0]}與{main_chars[1]}的故事"
         else:
-            import random
             fallback_titles = [
                 "神奇的冒險", "意想不到的旅程", "夢幻之旅", 
                 "奇遇記", "探險時光", "魔法故事"
@@ -549,7 +1137,7 @@ def _generate_story_title(paragraphs: list, characters: dict) -> str:
             return random.choice(fallback_titles)
 
 # 生成封面描述
-def _generate_cover_description(paragraphs: list, characters: dict, story_title: str = None) -> str:
+def _generate_cover_description(paragraphs: list, characters: dict, story_title: str = None, fresh: bool = False) -> str:
     if not paragraphs:
         return "A colorful storybook cover with charming characters."
 
@@ -576,22 +1164,10 @@ def _generate_cover_description(paragraphs: list, characters: dict, story_title:
     )
 
     try:
-        if _openai_mode == "sdk1":
-            resp = _oai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.6,
-                max_tokens=150
-            )
-            return resp.choices[0].message.content.strip()
-        else:
-            resp = _oai_client.ChatCompletion.create(
-                model="gpt-4o-mini",
-                messages=[{"role": "system", "content": sysmsg}],
-                temperature=0.6,
-                max_tokens=150
-            )
-            return resp["choices"][0]["message"]["content"].strip()
+        # 第一次畫封面沿用快取的描述：少一次 LLM 呼叫，prompt 不變也能直接命中生圖快取；
+        # 使用者同一個故事再說一次「畫封面」(fresh) 就是想換一張，重新產生描述
+        return _chat([{"role": "system", "content": sysmsg}], temperature=0.6,
+                     cache=not fresh, persist=True, max_tokens=150)
     except Exception as e:
         log.error("❌ OpenAI cover description generation error: %s", e)
         return "A whimsical storybook cover featuring the main character in a magical scene."
@@ -607,11 +1183,15 @@ BASE_STYLE = (
     "No text, letters, logos, watermarks, or brand names."
 )
 
+# 固定的畫風前綴只組一次；每張圖只需要接上場景與角色描述
+SCENE_PROMPT_PREFIX = f"{BASE_STYLE}, Scene: "
+STYLE_PROMPT_PREFIX = f"{BASE_STYLE}, "
+
 def build_scene_prompt(scene_desc: str, char_hint: str = "", extra: str = ""):
-    parts = [BASE_STYLE, f"Scene: {scene_desc}"]
-    if char_hint: parts.append(char_hint)
-    if extra:    parts.append(extra)
-    return ", ".join(parts)
+    prompt = SCENE_PROMPT_PREFIX + scene_desc
+    if char_hint: prompt += f", {char_hint}"
+    if extra:    prompt += f", {extra}"
+    return prompt
 
 # =============== Flask routes ===============
 @app.route("/")
@@ -626,16 +1206,37 @@ def callback():
     log.info("🌐 /callback hit | sig_present=%s | len=%s", bool(sig), len(body) if body else 0)
     if not sig:
         return "OK"
+    if not handler.parser.signature_validator.validate(body, sig):
+        log.error("❌ InvalidSignatureError")
+        abort(400)
+    if not _webhook_pending.acquire(blocking=False):
+        log.warning("⚠️ webhook backlog full (%d pending); asking LINE to retry later", WEBHOOK_MAX_PENDING)
+        return "Busy", 503
+    # 簽章正確就先回覆 LINE，實際處理（Firestore / OpenAI / reply）交給該使用者的 lane
+    try:
+        _webhook_lane(body).submit(_handle_webhook, body, sig)
+    except Exception:
+        _webhook_pending.release()
+        raise
+    return "OK"
+
+def _webhook_lane(body):
+    # 同一個 request 的事件通常來自同一人，用第一個事件的 userId 決定 lane
+    try:
+        events = orjson.loads(body).get("events") or [{}]
+        user_id = (events[0].get("source") or {}).get("userId") or ""
+    except Exception:
+        user_id = ""
+    return webhook_lanes[hash(user_id) % len(webhook_lanes)]
+
+def _handle_webhook(body, sig):
     try:
         handler.handle(body, sig)
         log.info("✅ handler.handle success")
-    except InvalidSignatureError:
-        log.error("❌ InvalidSignatureError")
-        abort(400)
     except Exception as e:
         log.exception("💥 handle error: %s", e)
-        abort(500)
-    return "OK"
+    finally:
+        _webhook_pending.release()
 
 # =============== LINE 主流程 ===============
 # 預設引導性回覆 (當AI模型呼叫失敗時使用)
@@ -661,123 +1262,239 @@ def generate_guiding_response(messages):
         "『哇，這個情節太有趣了！接下來要遇到什麼樣的挑戰呢？』"
     )
     # 取最近幾條對話歷史，作為模型的上下文
-    context_msgs = [{"role": "system", "content": sysmsg}] + messages[-6:]
+    recent = messages[-6:]
+    context_msgs = [{"role": "system", "content": sysmsg}] + _trim_to_budget(recent, size=lambda m: len(m["content"]))
     
     try:
-        if _openai_mode == "sdk1":
-            resp = _oai_client.chat.completions.create(
-                model="gpt-4o-mini", messages=context_msgs, temperature=0.7
-            )
-            return resp.choices[0].message.content.strip()
-        else:
-            resp = _oai_client.ChatCompletion.create(
-                model="gpt-4o-mini", messages=context_msgs, temperature=0.7
-            )
-            return resp["choices"][0]["message"]["content"].strip()
+        return _chat(context_msgs, temperature=0.7)
     except Exception as e:
         log.error("❌ OpenAI guiding response error: %s", e)
         return random.choice(GUIDING_RESPONSES) # 失敗時回歸通用引導
 
+# 指令判斷用的 regex，載入時編譯一次
+# hi 前後不能接英文字母，避免 this / white / chips 之類的字被當成打招呼
+_RE_GREETING = re.compile(r"((?<![A-Za-z])hi(?![A-Za-z])|你好|您好|哈囉)", re.IGNORECASE)
+_RE_NEW_STORY = re.compile(r"一起來講故事|我們來講個故事|開始說故事|說個故事|來點故事|我想寫故事")
+_RE_SUMMARY = re.compile(r"(整理|總結|summary)")
+_RE_TITLE = re.compile(r"(取標題|故事標題|給標題)")
+_RE_COVER = re.compile(r"(畫封面|故事封面)")
+_RE_DRAW = re.compile(r"(畫|請畫|幫我畫)第([一二三四五12345])段")   # group(2) 直接是段落編號
+PARA_INDEX = {'一': 0, '二': 1, '三': 2, '四': 3, '五': 4,
+              '1': 0, '2': 1, '3': 2, '4': 3, '5': 4}
+_RE_DRAW_GENERAL = re.compile(r"^(畫|請畫|幫我畫)(.*)")
+_RE_DRAW_ALL = re.compile(r"畫全部(段落)?|全部(段落)?都畫|每一段都畫")
+
+# =============== 固定回覆訊息（模組層級建立一次，重複使用） ===============
+# 「請稍候」這類過渡訊息不需要震動提醒，回覆時帶 notification_disabled=True
+MSG_GREETING = TextSendMessage("嗨！我是小繪機器人，一個喜歡聽故事並將它畫成插圖的夥伴！很開心認識你！")
+MSG_NEW_STORY = TextSendMessage("太棒了！小繪已經準備好了。我們來創造一個全新的故事吧！故事的主角是誰呢？")
+MSG_SUMMARY_WAIT = TextSendMessage("正在為你整理故事，請稍候一下下喔！")
+MSG_TITLE_NEED_STORY = TextSendMessage("請先說一個故事或用「整理目前的故事」指令來總結內容，我才能為故事取標題喔！")
+MSG_TITLE_WAIT = TextSendMessage("正在為你的故事想一個好聽的標題，請稍候一下下喔！")
+MSG_COVER_NEED_STORY = TextSendMessage("請先說一個故事或用「整理目前的故事」指令來總結內容，我才能為故事畫封面喔！")
+MSG_COVER_WAIT = TextSendMessage("正在為你的故事畫封面，請稍候一下下喔！")
+MSG_DRAW_NEED_SUMMARY = TextSendMessage("我需要再多一點故事內容，才能開始畫喔！請用「整理故事」指令來總結。")
+MSG_DRAW_BUSY = TextSendMessage("小繪還在畫上一張圖，畫好之後再請我畫下一張喔！")
+MSG_TEXT_ONLY = TextSendMessage("目前我只看得懂文字訊息喔～")
+MSG_STORY_DONE = TextSendMessage("故事已經全部完成囉！")
+MSG_SUMMARY_FAIL = TextSendMessage("整理故事時遇到小狀況，等等再試一次可以嗎？")
+MSG_TITLE_NO_STORY = TextSendMessage("目前沒有故事內容可以取標題喔，請先說一個故事或整理內容。")
+MSG_TITLE_FAIL = TextSendMessage("取標題時遇到小狀況，等等再試一次可以嗎？")
+MSG_NEED_MORE = TextSendMessage("我需要再多一點故事內容，才能開始畫喔～")
+MSG_GEN_FAIL = TextSendMessage("圖片生成暫時失敗了，稍後再試一次可以嗎？")
+MSG_UPLOAD_FAIL = TextSendMessage("上傳圖片時出了點狀況，等等再請我重畫一次～")
+MSG_DRAW_FAIL = TextSendMessage("生成中遇到小狀況，等等再試一次可以嗎？")
+MSG_ALL_DRAWN = TextSendMessage("太棒了，每一段故事圖都畫好了！要不要讓小繪為故事畫一個封面呢？")
+MSG_DRAW_ALL_WAIT = TextSendMessage("收到！小繪同時開始畫每一段的插圖，畫好一張就先傳給你喔～")
+MSG_COVER_NO_STORY = TextSendMessage("沒有故事內容可以畫封面喔，請先說一個故事或整理內容。")
+MSG_COVER_FAIL = TextSendMessage("生成封面時遇到小狀況，等等再試一次可以嗎？")
+MSG_IMAGE_GIFT = TextSendMessage("這張插圖送給你！")
+MSG_COVER_DONE = TextSendMessage("故事封面完成啦！🎉")
+
+# 整理 / 取標題 / 畫封面 / 畫圖 這些指令合成一個 pattern，過濾整串對話紀錄時每則只掃一次
+_RE_STORY_COMMAND = re.compile("|".join(p.pattern for p in (
+    _RE_SUMMARY, _RE_TITLE, _RE_COVER, _RE_DRAW, _RE_DRAW_ALL, _RE_DRAW_GENERAL)))
+
+def _is_story_command(text: str) -> bool:
+    return bool(_RE_STORY_COMMAND.search(text))
+
+# LINE 在我們回應慢或失敗時會重送同一個事件（webhookEventId 相同）；
+# 同一事件只處理一次，重送的「畫第N段」不會在生圖鎖釋放後又多畫一張
+EVENT_DEDUP_TTL = 600   # 秒
+EVENT_DEDUP_MAX = 4096
+_seen_events = OrderedDict()
+_seen_events_lock = threading.Lock()
+
+def _is_duplicate_event(event) -> bool:
+    event_id = getattr(event, "webhook_event_id", None)
+    if not event_id:
+        return False
+    if rds:
+        try:
+            return not rds.set(f"evt:{event_id}", "1", nx=True, ex=EVENT_DEDUP_TTL)
+        except Exception as e:
+            log.warning("⚠️ redis event dedup failed: %s", e)
+    now = time.time()
+    with _seen_events_lock:
+        while _seen_events and (len(_seen_events) >= EVENT_DEDUP_MAX or now - next(iter(_seen_events.values())) > EVENT_DEDUP_TTL):
+            _seen_events.popitem(last=False)
+        if event_id in _seen_events:
+            return True
+        _seen_events[event_id] = now
+    return False
+
 @handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     text = (event.message.text or "").strip()
     log.info("📩 LINE text | user=%s | text=%s", user_id, text)
+    if _is_duplicate_event(event):
+        log.info("🔁 skip redelivered event | user=%s | event_id=%s", user_id, event.webhook_event_id)
+        return
 
     sess = _ensure_session(user_id)
-    load_current_story(user_id, sess)
     
     reply_token = event.reply_token
 
     # 1. 處理特殊指令和打招呼
-    is_greeting = bool(re.search(r"(hi|Hi|你好|您好|哈囉)", text, re.IGNORECASE))
-    is_new_story = bool(re.search(r"一起來講故事|我們來講個故事|開始說故事|說個故事|來點故事|我想寫故事", text))
-    is_summary_request = bool(re.search(r"(整理|總結|summary)", text))
-    is_title_request = bool(re.search(r"(取標題|故事標題|給標題)", text))
-    is_cover_request = bool(re.search(r"(畫封面|故事封面)", text))
-
-    if is_greeting:
-        line_bot_api.reply_message(reply_token, TextSendMessage("嗨！我是小繪機器人，一個喜歡聽故事並將它畫成插圖的夥伴！很開心認識你！"))
-        # 這裡不加 return，讓它繼續執行後續邏輯
+    is_greeting = bool(_RE_GREETING.search(text))
+    is_new_story = bool(_RE_NEW_STORY.search(text))
+    is_summary_request = bool(_RE_SUMMARY.search(text))
+    is_title_request = bool(_RE_TITLE.search(text))
+    is_cover_request = bool(_RE_COVER.search(text))
+    m_paragraph_draw = _RE_DRAW.search(text)
+    is_draw_all = bool(_RE_DRAW_ALL.search(text))
+
+    # reply token 只能用一次：打招呼不先單獨回覆，而是併進同一次 reply 的訊息列表裡，再繼續執行後續邏輯
+    greeting = [MSG_GREETING] if is_greeting else []
     
     if is_new_story:
-        user_sessions[user_id] = {"messages": [], "paras": [], "characters": {}, "story_id": None, "story_title": None, "story_mode": True}
+        with _sessions_lock:
+            # 新故事不要再從 Firestore 讀回舊故事
+            new_sess = user_sessions[user_id] = {"messages": deque(maxlen=MAX_MESSAGES), "paras": [], "characters": {}, "story_id": None, "story_title": None, "story_mode": True, "_story_loaded": True, "seed": sess.get("seed"), "_lock": threading.RLock()}
+        if rds:
+            with new_sess["_lock"]:
+                new_sess["story_id"] = f"story-{int(time.time())}-{random.randint(1000,9999)}"
+            try:
+                rds.delete(f"sess:{user_id}:messages")
+            except Exception as e:
+                log.warning("⚠️ redis reset messages failed: %s", e)
+            _redis_save_session(user_id, new_sess)
         _ensure_session(user_id) # 重新初始化 session
-        line_bot_api.reply_message(reply_token, TextSendMessage("太棒了！小繪已經準備好了。我們來創造一個全新的故事吧！故事的主角是誰呢？"))
+        line_bot_api.reply_message(reply_token, greeting + [MSG_NEW_STORY])
         return
 
     # 將使用者訊息存入 session
-    sess["messages"].append({"role": "user", "content": text})
-    if len(sess["messages"]) > 60:
-        sess["messages"] = sess["messages"][-60:]
+    append_message(user_id, sess, "user", text)
     save_chat(user_id, "user", text)
 
-    # 在每次用戶發言後，只有在故事模式下才更新角色卡
-    if sess.get("story_mode", False):
-        threading.Thread(target=maybe_update_character_card, args=(sess, user_id, text), daemon=True).start()
+    # 在每次用戶發言後，只有在故事模式下才更新角色卡；
+    # 整理 / 取標題 / 畫封面 / 畫圖 這類指令不會帶出新的角色特徵，省掉一次 LLM 呼叫；
+    # 和摘要過濾共用同一份指令清單（_RE_STORY_COMMAND），兩邊不會各改各的
+    if sess.get("story_mode", False) and not _is_story_command(text):
+        schedule_character_update(sess, user_id, text)
 
 
     # 2. 處理「整理」指令
     if is_summary_request:
-        line_bot_api.reply_message(reply_token, TextSendMessage("正在為你整理故事，請稍候一下下喔！"))
+        line_bot_api.reply_message(reply_token, greeting + [MSG_SUMMARY_WAIT], notification_disabled=True)
         
         # 使用線程處理耗時的總結任務
-        threading.Thread(target=_summarize_and_push, args=(user_id,), daemon=True).start()
+        story_executor.submit(_summarize_and_push, user_id, sess)
         return
 
     # 2.5 處理「取標題」指令
     if is_title_request:
         if not sess.get("paras"):
-            line_bot_api.reply_message(reply_token, TextSendMessage("請先說一個故事或用「整理目前的故事」指令來總結內容，我才能為故事取標題喔！"))
+            line_bot_api.reply_message(reply_token, greeting + [MSG_TITLE_NEED_STORY])
             return
         
-        line_bot_api.reply_message(reply_token, TextSendMessage("正在為你的故事想一個好聽的標題，請稍候一下下喔！"))
-        threading.Thread(target=_generate_title_and_push, args=(user_id,), daemon=True).start()
+        line_bot_api.reply_message(reply_token, greeting + [MSG_TITLE_WAIT], notification_disabled=True)
+        story_executor.submit(_generate_title_and_push, user_id, sess)
         return
 
     # 2.7 處理「畫封面」指令
     if is_cover_request:
         if not sess.get("paras"):
-            line_bot_api.reply_message(reply_token, TextSendMessage("請先說一個故事或用「整理目前的故事」指令來總結內容，我才能為故事畫封面喔！"))
+            line_bot_api.reply_message(reply_token, greeting + [MSG_COVER_NEED_STORY])
             return
         
-        line_bot_api.reply_message(reply_token, TextSendMessage("正在為你的故事畫封面，請稍候一下下喔！"))
-        threading.Thread(target=_draw_cover_image_and_push, args=(user_id,), daemon=True).start()
+        lock_token = acquire_draw_lock(user_id)
+        if not lock_token:
+            line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_BUSY])
+            return
+        _reply_draw_ack(user_id, lock_token, reply_token, greeting + [MSG_COVER_WAIT])
+        image_executor.submit(_draw_cover_image_and_push, user_id, sess, lock_token)
         return
     
     # 3. 處理「畫圖」指令 (關鍵修正部分)
-    # 優先檢查是否為指定段落的畫圖指令
-    m_paragraph_draw = re.search(r"(畫|請畫|幫我畫)(第[一二三四五12345]段)", text)
+    # 「畫全部段落」：每段同時生成，不必一段一段等
+    if is_draw_all:
+        if not sess.get("paras"):
+            line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_NEED_SUMMARY])
+            return
+
+        lock_token = acquire_draw_lock(user_id)
+        if not lock_token:
+            line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_BUSY])
+            return
+        _reply_draw_ack(user_id, lock_token, reply_token, greeting + [MSG_DRAW_ALL_WAIT])
+        image_executor.submit(_draw_all_and_push, user_id, sess, lock_token)
+        return
+
+    # 再檢查是否為指定段落的畫圖指令
     if m_paragraph_draw:
-        prompt_text = m_paragraph_draw.group(2)
-        n_map = {'一': 1, '二': 2, '三': 3, '四': 4, '五': 5,
-                 '1': 1, '2': 2, '3': 3, '4': 4, '5': 5}
-        idx = n_map[re.sub(r"第(.)段", r"\1", prompt_text)] - 1
-        extra = re.sub(r"(畫|請畫|幫我畫)第[一二三四五12345]段", "", text).strip(" ，,。.!！")
+        idx = PARA_INDEX[m_paragraph_draw.group(2)]
+        extra = _RE_DRAW.sub("", text).strip(" ，,。.!！")
     
         # 檢查故事內容是否存在
         if not sess.get("paras") or idx >= len(sess["paras"]):
-            line_bot_api.reply_message(reply_token, TextSendMessage("我需要再多一點故事內容，才能開始畫喔！請用「整理故事」指令來總結。"))
+            line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_NEED_SUMMARY])
             return
 
-        line_bot_api.reply_message(reply_token, TextSendMessage(f"收到！第 {idx+1} 段的插圖開始生成，請稍候一下下喔～"))
-        threading.Thread(target=_draw_and_push, args=(user_id, idx, extra), daemon=True).start()
+        lock_token = acquire_draw_lock(user_id)
+        if not lock_token:
+            line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_BUSY])
+            return
+        _reply_draw_ack(user_id, lock_token, reply_token, greeting + [TextSendMessage(f"收到！第 {idx+1} 段的插圖開始生成，請稍候一下下喔～")])
+        image_executor.submit(_draw_and_push, user_id, sess, idx, extra, lock_token)
         return
 
     # 如果不是指定段落的，再檢查是否為不指定段落的單純畫圖指令
-    m_general_draw = re.search(r"^(畫|請畫|幫我畫)(.*)", text)
+    m_general_draw = _RE_DRAW_GENERAL.search(text)
     if m_general_draw:
         prompt_text = m_general_draw.group(2).strip(" ，,。.!！")
         if prompt_text:
-            line_bot_api.reply_message(reply_token, TextSendMessage(f"收到！小繪正在為你畫「{prompt_text}」，請稍候一下下喔～"))
-            threading.Thread(target=_draw_single_image_and_push, args=(user_id, prompt_text), daemon=True).start()
+            lock_token = acquire_draw_lock(user_id)
+            if not lock_token:
+                line_bot_api.reply_message(reply_token, greeting + [MSG_DRAW_BUSY])
+                return
+            _reply_draw_ack(user_id, lock_token, reply_token, greeting + [TextSendMessage(f"收到！小繪正在為你畫「{prompt_text}」，請稍候一下下喔～")])
+            image_executor.submit(_draw_single_image_and_push, user_id, sess, prompt_text, lock_token)
             return
     
     # 4. 如果沒有特殊指令，處理一般對話，交由 AI 模型來生成引導
-    if not is_greeting: # 如果不是打招呼，才發送引導訊息
-        guiding_response = generate_guiding_response(sess["messages"])
-        line_bot_api.reply_message(reply_token, TextSendMessage(guiding_response))
+    if is_greeting: # 單純打招呼就只回招呼，不發送引導訊息
+        line_bot_api.reply_message(reply_token, MSG_GREETING)
+        return
+    with sess["_lock"]:
+        recent = list(sess["messages"])
+    # LLM 呼叫可能要好幾秒（最壞等到 OPENAI_TIMEOUT），不能佔著這位使用者的 webhook lane，
+    # 否則同一條 lane 上的其他使用者都得跟著等
+    story_executor.submit(_guide_and_reply, user_id, reply_token, recent)
+
+def _guide_and_reply(user_id, reply_token, recent):
+    try:
+        guiding_response = generate_guiding_response(recent)
+        try:
+            line_bot_api.reply_message(reply_token, TextSendMessage(guiding_response))
+        except LineBotApiError as e:
+            # reply token 已過期（模型回得太慢）就改用 push
+            log.warning("⚠️ guiding reply failed, falling back to push | user=%s | %s", user_id, e)
+            line_bot_api.push_message(user_id, TextSendMessage(guiding_response))
         save_chat(user_id, "assistant", guiding_response)
+    except Exception as e:
+        log.exception("💥 [bg] guiding reply fail | user=%s | %s", user_id, e)
 
 @handler.add(MessageEvent)
 def handle_non_text(event):
@@ -785,56 +1502,138 @@ def handle_non_text(event):
     etype = type(event.message).__name__
     log.info("🧾 LINE non-text | user=%s | type=%s", user_id, etype)
     try:
-        line_bot_api.reply_message(event.reply_token, TextSendMessage("目前我只看得懂文字訊息喔～"))
+        line_bot_api.reply_message(event.reply_token, MSG_TEXT_ONLY)
     except Exception:
         pass
 
+# =============== 生圖鎖：每位使用者同時只跑一張圖 ===============
+# 有 Redis 時跨 worker 共用（SET NX EX），否則退回行程內的到期時間表
+# TTL 要比一次生圖工作的最壞情況長：生圖最多 RETRY_ATTEMPTS 次、每次等到 OPENAI_TIMEOUT，
+# 封面還要先呼叫一次 chat（SDK 內建最多 3 次），再加上退避、限流與 GCS 上傳的餘裕
+DRAW_LOCK_TTL = int(os.environ.get("DRAW_LOCK_TTL", str(int((RETRY_ATTEMPTS + 3) * OPENAI_TIMEOUT + 300))))
+_draw_locks = {}   # user_id -> (expires_at, token)
+_draw_locks_guard = threading.Lock()
+
+# 只刪掉自己拿到的鎖：鎖若已過期被別的工作拿走，舊工作的 finally 不會把別人的鎖刪掉
+_RELEASE_LOCK_LUA = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+_release_lock_script = rds.register_script(_RELEASE_LOCK_LUA) if rds else None
+
+def acquire_draw_lock(user_id):
+    """拿到鎖就回傳 owner token（釋放時要帶回來），已被占用回傳 None。"""
+    token = uuid.uuid4().hex
+    if rds:
+        try:
+            return token if rds.set(f"lock:draw:{user_id}", token, nx=True, ex=DRAW_LOCK_TTL) else None
+        except Exception as e:
+            log.warning("⚠️ redis draw lock failed: %s", e)
+    now = time.time()
+    with _draw_locks_guard:
+        held = _draw_locks.get(user_id)
+        if held and held[0] > now:
+            return None
+        _draw_locks[user_id] = (now + DRAW_LOCK_TTL, token)
+        return token
+
+def release_draw_lock(user_id, token):
+    if rds:
+        try:
+            _release_lock_script(keys=[f"lock:draw:{user_id}"], args=[token])
+        except Exception as e:
+            log.warning("⚠️ redis draw unlock failed: %s", e)
+    with _draw_locks_guard:
+        held = _draw_locks.get(user_id)
+        if held and held[1] == token:
+            del _draw_locks[user_id]
+
+def _reply_draw_ack(user_id, lock_token, reply_token, messages):
+    # 回覆失敗（reply token 過期、重複使用）時工作不會送出，先把鎖還回去，使用者才不會一直收到「還在畫」
+    try:
+        line_bot_api.reply_message(reply_token, messages, notification_disabled=True)
+    except Exception:
+        release_draw_lock(user_id, lock_token)
+        raise
+
 # =============== 背景生成並 push ===============
-def _summarize_and_push(user_id):
+SUMMARY_MAX_LINES = 8   # 摘要只看最近幾句故事內容
+
+# 背景工作直接沿用 handle_message 剛載入的 sess，不再各自 _ensure_session（省一次鎖與 Redis / Firestore 讀取）
+def _summarize_and_push(user_id, sess):
     try:
-        sess = _ensure_session(user_id)
-        load_current_story(user_id, sess)
-        
-        compact = [{"role": "user", "content": "\n".join([m["content"] for m in sess["messages"] if m["role"] == "user"][-8:])}]
-        characters_list = list(sess["characters"].keys())
-        summary = generate_story_summary(compact, characters_list) or "1.\n2.\n3.\n4.\n5."
-        paras = extract_paragraphs(summary)
-        
-        sess["paras"] = paras
-        sess["story_id"] = f"story-{int(time.time())}-{random.randint(1000,9999)}"
-        
-        # 生成故事標題
-        story_title = _generate_story_title(paras, sess["characters"])
-        sess["story_title"] = story_title
+        # 「整理 / 取標題 / 畫封面 / 畫第N段」這類指令不是故事內容，不送進摘要，也不影響快取 key。
+        # 從最新往回找，湊滿 SUMMARY_MAX_LINES 句就停，不必每次掃完整串對話
+        with sess["_lock"]:
+            story_lines = []
+            for m in reversed(sess["messages"]):
+                if m["role"] == "user" and not _is_story_command(m["content"]):
+                    story_lines.append(m["content"])
+                    if len(story_lines) >= SUMMARY_MAX_LINES:
+                        break
+            story_lines.reverse()
+            characters = dict(sess["characters"])
+        story_lines = _trim_to_budget(story_lines)
+        compact = [{"role": "user", "content": "\n".join(story_lines)}]
+        characters_list = list(characters.keys())
+        summary_key = hashlib.sha256(orjson.dumps([compact[0]["content"], characters_list])).hexdigest()
+
+        if sess.get("paras") and sess.get("_summary_key") == summary_key:
+            # 上次整理後沒有新的故事內容：直接沿用，不再呼叫 OpenAI
+            log.info("♻️ [bg] summary cache hit | user=%s", user_id)
+            paras, story_title = sess["paras"], sess.get("story_title") or "未命名故事"
+            summary = "\n".join(f"{i}. {p}" for i, p in enumerate(paras, 1))
+        else:
+            result = generate_story_summary_with_title(compact, characters_list)
+            if result:
+                summary, paras, story_title = result
+            else:
+                # JSON 解析失敗時退回原本的「先整理、再取標題」兩次呼叫
+                summary = generate_story_summary(compact, characters_list)
+                paras = extract_paragraphs(summary)
+                if not paras:
+                    # 摘要失敗或切不出任何段落：不要用空段落蓋掉上一版故事
+                    log.warning("⚠️ [bg] summary has no paragraphs | user=%s", user_id)
+                    line_bot_api.push_message(user_id, MSG_SUMMARY_FAIL)
+                    return
+                story_title = _generate_story_title(paras, characters)
+            
+            with sess["_lock"]:
+                sess["paras"] = paras
+                sess["story_id"] = f"story-{int(time.time())}-{random.randint(1000,9999)}"
+                sess["story_title"] = story_title
+                sess["_summary_key"] = summary_key
 
-        save_current_story(user_id, sess)
+            save_current_story(user_id, sess)
         
         msgs = [TextSendMessage(f"✨ 故事總結完成！這就是我們目前的故事：\n【{story_title}】\n" + summary)]
         
         # 判斷是否所有五段都已存在，如果是則提示畫封面
         if len(sess["paras"]) == 5:
-            msgs.append(TextSendMessage("故事已經全部完成囉！"))
+            msgs.append(MSG_STORY_DONE)
 
         line_bot_api.push_message(user_id, msgs)
         save_chat(user_id, "assistant", "故事總結：\n" + summary)
     except Exception as e:
         log.exception("💥 [bg] summarize fail: %s", e)
         try:
-            line_bot_api.push_message(user_id, TextSendMessage("整理故事時遇到小狀況，等等再試一次可以嗎？"))
+            line_bot_api.push_message(user_id, MSG_SUMMARY_FAIL)
         except Exception:
             pass
 
-def _generate_title_and_push(user_id):
+def _generate_title_and_push(user_id, sess):
     try:
-        sess = _ensure_session(user_id)
-        load_current_story(user_id, sess)
-
         if not sess.get("paras"):
-            line_bot_api.push_message(user_id, TextSendMessage("目前沒有故事內容可以取標題喔，請先說一個故事或整理內容。"))
+            line_bot_api.push_message(user_id, MSG_TITLE_NO_STORY)
             return
 
-        story_title = _generate_story_title(sess["paras"], sess["characters"])
-        sess["story_title"] = story_title
+        with sess["_lock"]:
+            paras, characters = list(sess["paras"]), dict(sess["characters"])
+        story_title = _generate_story_title(paras, characters)
+        with sess["_lock"]:
+            sess["story_title"] = story_title
         save_current_story(user_id, sess)
         
         line_bot_api.push_message(user_id, TextSendMessage(f"故事標題：【{story_title}】"))
@@ -843,48 +1642,124 @@ def _generate_title_and_push(user_id):
     except Exception as e:
         log.exception("💥 [bg] generate title fail: %s", e)
         try:
-            line_bot_api.push_message(user_id, TextSendMessage("取標題時遇到小狀況，等等再試一次可以嗎？"))
+            line_bot_api.push_message(user_id, MSG_TITLE_FAIL)
         except Exception:
             pass
 
 
-def _draw_and_push(user_id, idx, extra):
+def _paragraph_prompt(sess, idx, extra=""):
+    with sess["_lock"]:
+        scene = sess["paras"][idx]
+        characters = dict(sess.get("characters", {}))
+    
+    # 步驟一：從當前段落中提取角色名稱
+    mentioned_char_names = _extract_characters_from_text(scene, characters)
+    
+    # 步驟二：根據提取到的名稱，篩選出對應的角色卡
+    filtered_characters = {name: characters[name] for name in mentioned_char_names if name in characters}
+    
+    # 步驟三：後台列印出用於畫圖的角色卡資訊
+    log.info("🖼️ [bg] Characters for image generation: %s", orjson.dumps(_characters_to_dict(filtered_characters)).decode())
+
+    # 步驟四：使用篩選後的角色卡生成提示詞
+    char_hint = render_character_card_as_text(filtered_characters)
+    return build_scene_prompt(scene_desc=scene, char_hint=char_hint, extra=extra)
+
+# 同一個 prompt 正在生成中（連按兩次「畫第1段」、預抓下一段時使用者剛好也要畫）就等同一份結果，不重複花生圖費用
+_image_inflight = {}   # cache_key -> Future[(public_url, 失敗訊息)]
+_image_inflight_lock = threading.Lock()
+
+def _image_url_for(user_id, prompt, fname, fresh=False):
+    """
+    依序查生圖快取、併入進行中的同 prompt 工作，都沒有才真的生圖並上傳。
+    fresh=True（使用者要求重畫）時跳過快取直接生成，新圖仍會寫回快取。
+    回傳 (public_url, None)；失敗時回傳 (None, 要推給使用者的訊息)。
+    """
+    size = _normalize_size(IMAGE_SIZE_ENV)
+    cache_key = _image_cache_key(prompt, size)
+    public_url = None if fresh else image_cache_get(cache_key)
+    if public_url:
+        log.info("♻️ [bg] image cache hit | user=%s | key=%s", user_id, cache_key[:12])
+        return public_url, None
+
+    with _image_inflight_lock:
+        fut = _image_inflight.get(cache_key)
+        owner = fut is None
+        if owner:
+            fut = _image_inflight[cache_key] = Future()
+    if not owner:
+        log.info("🔗 [bg] joined in-flight image | user=%s | key=%s", user_id, cache_key[:12])
+        return fut.result()
+
+    try:
+        img_bytes = openai_images_generate(prompt, size=size)
+        if not img_bytes:
+            result = (None, MSG_GEN_FAIL)
+        else:
+            public_url = gcs_upload_bytes(img_bytes, fname, IMAGE_CONTENT_TYPE)
+            if public_url:
+                image_cache_put(cache_key, public_url)
+                result = (public_url, None)
+            else:
+                result = (None, MSG_UPLOAD_FAIL)
+        fut.set_result(result)
+        return result
+    except Exception as e:
+        fut.set_exception(e)
+        raise
+    finally:
+        with _image_inflight_lock:
+            _image_inflight.pop(cache_key, None)
+
+def _is_redraw(sess, target):
+    """
+    記錄這個故事畫過哪些目標（段落 idx、"cover"、單張圖的文字）。
+    同一個故事第二次要求同一個目標就是想換一張，回傳 True 讓呼叫端跳過快取。
+    """
+    with sess["_lock"]:
+        drawn = sess.setdefault("_drawn", set())
+        key = (sess.get("story_id"), target)
+        if key in drawn:
+            return True
+        drawn.add(key)
+        return False
+
+# 畫完第 N 段後先在背景把第 N+1 段（不含額外指示）畫進快取，使用者接著說「畫第N+1段」就直接命中。
+# 會多花生圖費用（使用者不一定會畫下一段），所以預設關閉
+PREFETCH_NEXT_IMAGE = os.environ.get("PREFETCH_NEXT_IMAGE", "0") == "1"
+
+def _prefetch_paragraph_image(user_id, sess, idx):
+    try:
+        paras = sess.get("paras") or []
+        if idx >= len(paras):
+            return
+        prompt = _paragraph_prompt(sess, idx)
+        fname = f"line_images/{user_id}-{uuid.uuid4().hex}_s{idx+1}.{IMAGE_EXT}"
+        public_url, _ = _image_url_for(user_id, prompt, fname)
+        if public_url:
+            log.info("🔮 [bg] prefetched paragraph image | user=%s | idx=%d", user_id, idx)
+    except Exception as e:
+        log.warning("⚠️ [bg] prefetch failed | user=%s | idx=%d | %s", user_id, idx, e)
+
+def _draw_and_push(user_id, sess, idx, extra, lock_token):
     try:
-        sess = _ensure_session(user_id)
-        load_current_story(user_id, sess)
         log.info("🎯 [bg] draw request | user=%s | idx=%d | extra=%s | story_id=%s", user_id, idx, extra, sess.get("story_id"))
 
         paras = sess.get("paras") or []
         if not paras or idx >= len(paras):
-            line_bot_api.push_message(user_id, TextSendMessage("我需要再多一點故事內容，才能開始畫喔～"))
+            line_bot_api.push_message(user_id, MSG_NEED_MORE)
             return
 
-        scene = paras[idx]
-        
-        # 步驟一：從當前段落中提取角色名稱
-        mentioned_char_names = _extract_characters_from_text(scene, sess.get("characters", {}))
-        
-        # 步驟二：根據提取到的名稱，篩選出對應的角色卡
-        filtered_characters = {name: sess["characters"][name] for name in mentioned_char_names if name in sess["characters"]}
-        
-        # 步驟三：後台列印出用於畫圖的角色卡資訊
-        log.info("🖼️ [bg] Characters for image generation: %s", json.dumps({k:v.__dict__ for k,v in filtered_characters.items()}, ensure_ascii=False))
-
-        # 步驟四：使用篩選後的角色卡生成提示詞
-        char_hint = render_character_card_as_text(filtered_characters)
-        prompt = build_scene_prompt(scene_desc=scene, char_hint=char_hint, extra=extra)
+        prompt = _paragraph_prompt(sess, idx, extra)
         log.info("🧩 [bg] prompt head: %s", prompt[:200])
 
-        size = _normalize_size(IMAGE_SIZE_ENV)
-        img_bytes = openai_images_generate(prompt, size=size)
-        if not img_bytes:
-            line_bot_api.push_message(user_id, TextSendMessage("圖片生成暫時失敗了，稍後再試一次可以嗎？"))
-            return
-
-        fname = f"line_images/{user_id}-{uuid.uuid4().hex[:6]}_s{idx+1}.png"
-        public_url = gcs_upload_bytes(img_bytes, fname, "image/png")
+        fresh = _is_redraw(sess, idx)
+        if fresh:
+            log.info("🔄 [bg] redraw requested, bypassing cache | user=%s | idx=%d", user_id, idx)
+        fname = f"line_images/{user_id}-{uuid.uuid4().hex}_s{idx+1}.{IMAGE_EXT}"
+        public_url, fail_msg = _image_url_for(user_id, prompt, fname, fresh=fresh)
         if not public_url:
-            line_bot_api.push_message(user_id, TextSendMessage("上傳圖片時出了點狀況，等等再請我重畫一次～"))
+            line_bot_api.push_message(user_id, fail_msg)
             return
 
         msgs = [
@@ -897,42 +1772,113 @@ def _draw_and_push(user_id, idx, extra):
             next_scene_preview = paras[idx + 1]
             msgs.append(TextSendMessage(f"要不要繼續畫第 {idx+2} 段內容呢？\n下一段的故事是：\n「{next_scene_preview}」"))
         elif idx + 1 == 5: # 如果這是最後一段
-            msgs.append(TextSendMessage("太棒了，五段故事圖都畫好了！要不要讓小繪為故事畫一個封面呢？"))
+            msgs.append(MSG_ALL_DRAWN)
 
         line_bot_api.push_message(user_id, msgs)
         log.info("✅ [bg] push image sent | user=%s | url=%s", user_id, public_url)
 
         save_chat(user_id, "assistant", f"[image]{public_url}")
 
+        if PREFETCH_NEXT_IMAGE and idx + 1 < len(paras):
+            image_executor.submit(_prefetch_paragraph_image, user_id, sess, idx + 1)
+
     except Exception as e:
         log.exception("💥 [bg] draw fail: %s", e)
         try:
-            line_bot_api.push_message(user_id, TextSendMessage("生成中遇到小狀況，等等再試一次可以嗎？"))
+            line_bot_api.push_message(user_id, MSG_DRAW_FAIL)
+        except Exception:
+            pass
+    finally:
+        release_draw_lock(user_id, lock_token)
+
+# 「畫全部段落」同一位使用者同時最多佔幾個生圖 worker，其餘段落排在自己後面，不會卡住別人畫圖
+DRAW_ALL_PARALLEL = int(os.environ.get("DRAW_ALL_PARALLEL", "2"))
+
+def _draw_all_and_push(user_id, sess, lock_token):
+    """
+    每一段輪流丟進 image_executor 生成（同時最多 DRAW_ALL_PARALLEL 段），畫好一段就先 push 一段；
+    最後一段完成時才釋放生圖鎖，全部成功就提示畫封面，有失敗的段落就一次列出來。
+    """
+    try:
+        # 開始前先把每段的 prompt 一次組好：途中有人「整理」換了段落，也不會混到兩個版本的故事
+        with sess["_lock"]:
+            prompts = [_paragraph_prompt(sess, idx) for idx in range(len(sess.get("paras") or []))]
+            redraw = [_is_redraw(sess, idx) for idx in range(len(prompts))]
+    except Exception as e:
+        log.exception("💥 [bg] draw-all prompt build fail | user=%s | %s", user_id, e)
+        prompts = None
+    if not prompts:
+        release_draw_lock(user_id, lock_token)
+        try:
+            line_bot_api.push_message(user_id, MSG_DRAW_FAIL if prompts is None else MSG_DRAW_NEED_SUMMARY)
         except Exception:
             pass
+        return
+
+    total = len(prompts)
+    state = {"next": min(DRAW_ALL_PARALLEL, total), "pending": total, "failed": []}
+    state_lock = threading.Lock()
 
-def _draw_single_image_and_push(user_id, prompt_text):
+    def _one(idx):
+        ok = False
+        try:
+            fname = f"line_images/{user_id}-{uuid.uuid4().hex}_s{idx+1}.{IMAGE_EXT}"
+            public_url, _ = _image_url_for(user_id, prompts[idx], fname, fresh=redraw[idx])
+            if public_url:
+                line_bot_api.push_message(user_id, [
+                    TextSendMessage(f"第 {idx+1} 段的插圖完成了！"),
+                    ImageSendMessage(public_url, public_url),
+                ])
+                save_chat(user_id, "assistant", f"[image]{public_url}")
+                ok = True
+        except Exception as e:
+            log.exception("💥 [bg] draw-all fail | user=%s | idx=%d | %s", user_id, idx, e)
+        finally:
+            with state_lock:
+                state["pending"] -= 1
+                if not ok:
+                    state["failed"].append(idx + 1)
+                nxt = state["next"] if state["next"] < total else None
+                if nxt is not None:
+                    state["next"] += 1
+                done, failed = state["pending"] == 0, sorted(state["failed"])
+            if nxt is not None:
+                image_executor.submit(_one, nxt)   # 自己這格空出來才接著畫下一段
+            if done:
+                release_draw_lock(user_id, lock_token)
+                log.info("✅ [bg] draw-all finished | user=%s | ok=%d/%d", user_id, total - len(failed), total)
+                try:
+                    if failed:
+                        nums = "、".join(map(str, failed))
+                        line_bot_api.push_message(user_id, TextSendMessage(
+                            f"第 {nums} 段沒有畫成功，等等再跟我說「畫第{failed[0]}段」試試看～"))
+                    else:
+                        line_bot_api.push_message(user_id, MSG_ALL_DRAWN)
+                except Exception:
+                    pass
+
+    log.info("🎯 [bg] draw-all request | user=%s | paragraphs=%d | story_id=%s", user_id, total, sess.get("story_id"))
+    for idx in range(state["next"]):
+        image_executor.submit(_one, idx)
+
+def _draw_single_image_and_push(user_id, sess, prompt_text, lock_token):
     try:
         log.info("🎯 [bg] single image request | user=%s | prompt=%s", user_id, prompt_text)
         
         # 使用者只提供一個簡單的畫圖指令，可以直接用作提示詞
-        prompt = f"{BASE_STYLE}, {prompt_text}"
-        
-        size = _normalize_size(IMAGE_SIZE_ENV)
-        img_bytes = openai_images_generate(prompt, size=size)
+        prompt = STYLE_PROMPT_PREFIX + prompt_text
         
-        if not img_bytes:
-            line_bot_api.push_message(user_id, TextSendMessage("圖片生成暫時失敗了，稍後再試一次可以嗎？"))
-            return
-
-        fname = f"line_images/{user_id}-{uuid.uuid4().hex[:6]}_single.png"
-        public_url = gcs_upload_bytes(img_bytes, fname, "image/png")
+        fresh = _is_redraw(sess, "single:" + prompt_text)
+        if fresh:
+            log.info("🔄 [bg] redraw requested, bypassing cache | user=%s | single", user_id)
+        fname = f"line_images/{user_id}-{uuid.uuid4().hex}_single.{IMAGE_EXT}"
+        public_url, fail_msg = _image_url_for(user_id, prompt, fname, fresh=fresh)
         if not public_url:
-            line_bot_api.push_message(user_id, TextSendMessage("上傳圖片時出了點狀況，等等再請我重畫一次～"))
+            line_bot_api.push_message(user_id, fail_msg)
             return
 
         msgs = [
-            TextSendMessage(f"這張插圖送給你！"),
+            MSG_IMAGE_GIFT,
             ImageSendMessage(public_url, public_url),
         ]
         line_bot_api.push_message(user_id, msgs)
@@ -942,45 +1888,43 @@ def _draw_single_image_and_push(user_id, prompt_text):
     except Exception as e:
         log.exception("💥 [bg] draw single image fail: %s", e)
         try:
-            line_bot_api.push_message(user_id, TextSendMessage("生成中遇到小狀況，等等再試一次可以嗎？"))
+            line_bot_api.push_message(user_id, MSG_DRAW_FAIL)
         except Exception:
             pass
+    finally:
+        release_draw_lock(user_id, lock_token)
 
-def _draw_cover_image_and_push(user_id):
+def _draw_cover_image_and_push(user_id, sess, lock_token):
     try:
-        sess = _ensure_session(user_id)
-        load_current_story(user_id, sess)
         log.info("🎯 [bg] cover image request | user=%s | story_id=%s", user_id, sess.get("story_id"))
         
-        paras = sess.get("paras") or []
+        with sess["_lock"]:
+            paras = list(sess.get("paras") or [])
+            characters = dict(sess.get("characters", {}))
         story_title = sess.get("story_title") or "奇妙的故事"
 
         if not paras:
-            line_bot_api.push_message(user_id, TextSendMessage("沒有故事內容可以畫封面喔，請先說一個故事或整理內容。"))
+            line_bot_api.push_message(user_id, MSG_COVER_NO_STORY)
             return
             
-        cover_desc = _generate_cover_description(paras, sess.get("characters", {}))
+        fresh = _is_redraw(sess, "cover")
+        if fresh:
+            log.info("🔄 [bg] redraw requested, bypassing cache | user=%s | cover", user_id)
+        cover_desc = _generate_cover_description(paras, characters, sess.get("story_title"), fresh=fresh)
         
         # 封面提示詞加入標題和角色資訊
-        char_hint = render_character_card_as_text(sess.get("characters", {}))
+        char_hint = render_character_card_as_text(characters)
         prompt = build_scene_prompt(scene_desc=cover_desc, char_hint=char_hint)
         log.info("🧩 [bg] cover prompt head: %s", prompt[:200])
 
-        size = _normalize_size(IMAGE_SIZE_ENV)
-        img_bytes = openai_images_generate(prompt, size=size)
-        
-        if not img_bytes:
-            line_bot_api.push_message(user_id, TextSendMessage("圖片生成暫時失敗了，稍後再試一次可以嗎？"))
-            return
-
-        fname = f"line_images/{user_id}-{sess.get('story_id')}-cover.png"
-        public_url = gcs_upload_bytes(img_bytes, fname, "image/png")
+        fname = f"line_images/{user_id}-{sess.get('story_id')}-{uuid.uuid4().hex}-cover.{IMAGE_EXT}"
+        public_url, fail_msg = _image_url_for(user_id, prompt, fname, fresh=fresh)
         if not public_url:
-            line_bot_api.push_message(user_id, TextSendMessage("上傳圖片時出了點狀況，等等再請我重畫一次～"))
+            line_bot_api.push_message(user_id, fail_msg)
             return
             
         msgs = [
-            TextSendMessage(f"故事封面完成啦！🎉"),
+            MSG_COVER_DONE,
             ImageSendMessage(public_url, public_url)
         ]
         
@@ -991,10 +1935,13 @@ def _draw_cover_image_and_push(user_id):
     except Exception as e:
         log.exception("💥 [bg] draw cover image fail: %s", e)
         try:
-            line_bot_api.push_message(user_id, TextSendMessage("生成封面時遇到小狀況，等等再試一次可以嗎？"))
+            line_bot_api.push_message(user_id, MSG_COVER_FAIL)
         except Exception:
             pass
+    finally:
+        release_draw_lock(user_id, lock_token)
 
+# 僅供本機開發；正式環境由 Dockerfile 的 gunicorn 啟動
 if __name__ == "__main__":
     app.run(debug=True, host="0.0.0.0", port=int(os.environ.get("PORT", 8080)))
     
@@ -0,0 +1,19 @@
+# Gunicorn 設定（Dockerfile 以 `gunicorn -c gunicorn.conf.py app:app` 啟動）
+# 所有參數都可以用環境變數覆寫，Cloud Run 上改設定不必重包映像檔
+import os
+
+# Cloud Run 會注入 PORT
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+
+# gthread：OpenAI / GCS / Firestore 都是阻塞 I/O，多執行緒就能併發。
+# 不用 gevent：firebase-admin / google-cloud 走 grpc，和 gevent 的 monkey patch 容易卡死
+worker_class = "gthread"
+
+# 沒有 Redis 時 session 只存在行程記憶體，必須維持 1 個 worker；
+# 設了 REDIS_URL 之後 session / 生圖鎖 / 快取都能跨 worker 共用，可以開多個
+workers = int(os.environ.get("WEB_CONCURRENCY", "2" if os.environ.get("REDIS_URL") else "1"))
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5